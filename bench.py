@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import time
+import socket
+import asyncio
+import argparse
+import logging
+import tempfile
+
+from fake_bot_api import FakeBotAPI, start_server
+
+# Бенчмарк gifts.py на локальном fake_bot_api: время цикла опроса, число вызовов API за цикл
+# и задержка от появления подарка до доставки уведомления о нём.
+
+# Находим свободный порт
+def free_port():
+    """Возвращает свободный TCP-порт на localhost."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+# Считаем перцентиль
+def percentile(values, p):
+    """Возвращает p-й перцентиль (методом ближайшего ранга)."""
+    if not values:
+        return float("nan")
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, round(p / 100 * len(ordered) + 0.5) - 1))
+    return ordered[index]
+
+# Настраиваем окружение и импортируем бота
+def import_bot(api_url, workdir):
+    """Импортирует gifts.py, направив его на локальный Bot API и временный каталог."""
+    os.environ.update({
+        "BOT_TOKEN": "123456:BENCHMARK",
+        "USER_ID": "1",
+        "CHANNEL_ID": "-1001",
+        "BOT_USERNAME": "bench_bot",
+        "BOT_API_URL": api_url,
+    })
+    # Остальные настройки можно переопределить переменными окружения
+    os.environ.setdefault("POLL_MIN_INTERVAL", "0.5")
+    os.environ.setdefault("POLL_MAX_INTERVAL", "2")
+    os.environ.setdefault("POLL_REQUESTS_PER_MINUTE", "600")
+    os.environ.setdefault("DELAY_BETWEEN_MESSAGES", "0")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import gifts
+    logging.getLogger().setLevel(logging.WARNING)
+    return gifts
+
+# Считаем ошибки в логе бота
+class ErrorCounter(logging.Handler):
+    """Запоминает сообщения уровня ERROR и выше: бенчмарк с ошибками в логе не считается успешным."""
+
+    def __init__(self):
+        super().__init__(logging.ERROR)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+# Ждём, пока не будут доставлены уведомления обо всех подарках
+async def wait_delivered(api, gift_ids, timeout):
+    """Ждёт доставки уведомлений о gift_ids. Возвращает True, если успели до timeout."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        delivered = api.delivered_at()
+        if all(gift_id in delivered for gift_id in gift_ids):
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+# Запускаем бенчмарк
+async def run(args):
+    api = FakeBotAPI(chat_rate_limit=args.chat_rate_limit, retry_after=args.retry_after)
+    port = free_port()
+    runner = await start_server(api, port=port)
+    workdir = tempfile.mkdtemp(prefix="gifts_bench_")
+    # Дополнительные подписчики без фильтров, кроме CHANNEL_ID
+    if args.subscribers:
+        with open(os.path.join(workdir, "subscribers.json"), "w") as f:
+            json.dump([{"chat_id": str(1000 + i)} for i in range(args.subscribers)], f)
+    gifts = import_bot(f"http://127.0.0.1:{port}", workdir)
+    errors = ErrorCounter()
+    logging.getLogger().addHandler(errors)
+
+    # Меряем длительность каждого цикла обработки
+    cycle_times = []
+    check_new_gifts = gifts.check_new_gifts
+    ensure_gift_stickers = gifts.ensure_gift_stickers
+    sticker_failures = []
+
+    # Загрузка стикеров не должна падать: иначе цикл обработки обрывается и замер неверен
+    async def checked_ensure_gift_stickers(*a, **kw):
+        try:
+            return await ensure_gift_stickers(*a, **kw)
+        except Exception as e:
+            sticker_failures.append(repr(e))
+            raise
+
+    gifts.ensure_gift_stickers = checked_ensure_gift_stickers
+
+    async def timed_check_new_gifts(*a, **kw):
+        started = time.perf_counter()
+        try:
+            return await check_new_gifts(*a, **kw)
+        finally:
+            cycle_times.append(time.perf_counter() - started)
+
+    gifts.check_new_gifts = timed_check_new_gifts
+
+    # Прогрев: стартовые подарки становятся известными до начала замера
+    initial = api.release(args.initial)
+    bot_task = asyncio.create_task(gifts.main())
+    warmed_up = await wait_delivered(api, initial, args.timeout)
+
+    cycle_times.clear()
+    api.calls.clear()
+    messages_before = len(api.messages)
+
+    # Релиз
+    released = api.release(args.release, total_count=args.supply)
+    for _ in range(args.floods):
+        api.flood("sendMessage")
+    delivered_in_time = await wait_delivered(api, released, args.timeout)
+
+    # Распродажа: проходим все уровни остатка, чтобы нагрузить пороговые уведомления
+    if args.drain_steps:
+        step = max(1, args.supply // args.drain_steps)
+        for _ in range(args.drain_steps):
+            for gift_id in released:
+                api.drain(gift_id, step)
+            await asyncio.sleep(gifts.scheduler.min_interval)
+        await asyncio.sleep(args.settle)
+
+    bot_task.cancel()
+    try:
+        await bot_task
+    except asyncio.CancelledError:
+        pass
+    await runner.cleanup()
+
+    delivered = api.delivered_at()
+    latencies = [delivered[gift_id] - api.appeared_at[gift_id] for gift_id in released if gift_id in delivered]
+    polls = api.calls.get("getavailablegifts", 0)
+    cycles = len(cycle_times)
+    report = {
+        "warmed_up": warmed_up,
+        "released": len(released),
+        "delivered": len(latencies),
+        "delivered_in_time": delivered_in_time,
+        "polls": polls,
+        "cycles": cycles,
+        "cycle_time_p50_ms": percentile(cycle_times, 50) * 1000,
+        "cycle_time_p99_ms": percentile(cycle_times, 99) * 1000,
+        "cycle_time_max_ms": max(cycle_times, default=float("nan")) * 1000,
+        "api_calls": dict(sorted(api.calls.items())),
+        "api_calls_per_cycle": (api.total_calls() - polls) / cycles if cycles else float("nan"),
+        "messages_sent": len(api.messages) - messages_before,
+        "latency_p50_ms": percentile(latencies, 50) * 1000,
+        "latency_p99_ms": percentile(latencies, 99) * 1000,
+        "latency_max_ms": max(latencies, default=float("nan")) * 1000,
+        "sticker_failures": sticker_failures,
+        "errors": errors.messages,
+    }
+    return report
+
+# Печатаем отчёт
+def print_report(report):
+    print(f"Релиз: {report['released']} подарков, доставлено уведомлений: {report['delivered']}"
+          f"{'' if report['delivered_in_time'] else ' (не уложились в таймаут)'}")
+    print(f"Опросов: {report['polls']}, циклов обработки: {report['cycles']}")
+    print(f"Цикл обработки: p50 {report['cycle_time_p50_ms']:.1f} мс, p99 {report['cycle_time_p99_ms']:.1f} мс, "
+          f"max {report['cycle_time_max_ms']:.1f} мс")
+    print(f"Вызовов API на цикл (без опроса): {report['api_calls_per_cycle']:.1f}, сообщений: {report['messages_sent']}")
+    for method, count in report["api_calls"].items():
+        print(f"  {method}: {count}")
+    print(f"Задержка появление → уведомление: p50 {report['latency_p50_ms']:.0f} мс, "
+          f"p99 {report['latency_p99_ms']:.0f} мс, max {report['latency_max_ms']:.0f} мс")
+    for failure in report["sticker_failures"]:
+        print(f"ensure_gift_stickers упал: {failure}")
+    print(f"Ошибок в логе: {len(report['errors'])}")
+    for message in report["errors"][:10]:
+        print(f"  {message}")
+
+# Основная функция
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк gifts.py на локальном Bot API")
+    parser.add_argument("--initial", type=int, default=20, help="Подарки, доступные до релиза")
+    parser.add_argument("--release", type=int, default=200, help="Сколько подарков появится в релизе")
+    parser.add_argument("--supply", type=int, default=1000, help="Тираж каждого подарка из релиза")
+    parser.add_argument("--drain-steps", type=int, default=10, help="За сколько опросов раскупить релиз (0 — не раскупать)")
+    parser.add_argument("--settle", type=float, default=5, help="Сколько секунд ждать уведомлений после распродажи")
+    parser.add_argument("--floods", type=int, default=0, help="Сколько ответов 429 выдать на sendMessage во время релиза")
+    parser.add_argument("--subscribers", type=int, default=0, help="Сколько подписчиков добавить к CHANNEL_ID")
+    parser.add_argument("--chat-rate-limit", type=float, default=None, help="Лимит сообщений в секунду на чат в fake API")
+    parser.add_argument("--retry-after", type=int, default=1)
+    parser.add_argument("--timeout", type=float, default=120, help="Сколько ждать доставки уведомлений, секунд")
+    parser.add_argument("--json", action="store_true", help="Вывести отчёт в JSON")
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=4))
+    else:
+        print_report(report)
+    if report["sticker_failures"] or report["errors"]:
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+import json
+import time
+import hashlib
+import random
+import asyncio
+import argparse
+import logging
+from aiohttp import web
+
+# Локальная замена Telegram Bot API для проверки gifts.py без настоящего токена.
+# Поддерживает только методы, которые вызывает бот, и хранит всё состояние в памяти.
+logger = logging.getLogger("fake_bot_api")
+
+# Состояние поддельного Bot API
+class FakeBotAPI:
+    """Состояние поддельного Bot API: подарки, стикерпаки, отправленные сообщения и счётчики вызовов.
+
+    Управляется из Python (release, drain, flood) или сценарием из командной строки.
+    """
+
+    def __init__(self, chat_rate_limit=None, chat_burst=3, retry_after=1):
+        self.gifts = {}  # gift_id → запись подарка в формате Bot API
+        self.appeared_at = {}  # gift_id → время появления подарка (time.monotonic)
+        self.sticker_sets = {}  # имя → список стикеров
+        self.unique_ids = {}  # file_id → file_unique_id
+        self.contents = {}  # file_unique_id → содержимое файла стикера
+        self.expired_file_ids = set()  # file_id, которые методы стикеров отклоняют как недействительные
+        self.messages = []  # Отправленные сообщения в порядке отправки
+        self.calls = {}  # метод → количество вызовов
+        self.floods = {}  # метод → сколько следующих вызовов ответить 429
+        self.chat_rate_limit = chat_rate_limit  # Сообщений в секунду на чат, сверх которых отвечаем 429
+        self.retry_after = retry_after
+        self.chat_burst = chat_burst  # Сколько сообщений подряд чат принимает без паузы
+        self.chat_tokens = {}  # chat_id → (доступные отправки, время последнего пересчёта)
+        self.next_gift_id = 5170000000000000000
+        self.next_message_id = 1
+        self.handlers = {
+            "getavailablegifts": self.get_available_gifts,
+            "getstickerset": self.get_sticker_set,
+            "createnewstickerset": self.create_new_sticker_set,
+            "addstickertoset": self.add_sticker_to_set,
+            "sendsticker": self.send_sticker,
+            "sendmessage": self.send_message,
+            "getfile": self.get_file,
+        }
+
+    # Сценарий
+
+    def release(self, count, total_count=None, star_count=None):
+        """Добавляет count новых подарков и возвращает их id."""
+        gift_ids = []
+        now = time.monotonic()
+        for _ in range(count):
+            gift_id = str(self.next_gift_id)
+            self.next_gift_id += 1
+            file_id = f"gift_sticker_{gift_id}"
+            self.unique_ids[file_id] = f"gift_{gift_id}"
+            # Стикеры подарков анимированные: TGS — это сжатый gzip Lottie, начинается с 1f 8b
+            self.contents[f"gift_{gift_id}"] = b"\x1f\x8b" + f"tgs:gift_{gift_id}".encode()
+            gift = {
+                "id": gift_id,
+                "sticker": {
+                    "file_id": file_id,
+                    "file_unique_id": self.unique_ids[file_id],
+                    "type": "regular",
+                    "width": 512,
+                    "height": 512,
+                    "is_animated": True,
+                    "is_video": False,
+                    "emoji": random.choice("🎁🧸💝🌹🎂💐🚀🏆💍💎"),
+                },
+                "star_count": star_count if star_count is not None else random.choice((15, 25, 50, 100, 500, 2500)),
+            }
+            if total_count:
+                gift["total_count"] = total_count
+                gift["remaining_count"] = total_count
+            self.gifts[gift_id] = gift
+            self.appeared_at[gift_id] = now
+            gift_ids.append(gift_id)
+        return gift_ids
+
+    def drain(self, gift_id, amount):
+        """Уменьшает остаток подарка на amount (не ниже нуля)."""
+        gift = self.gifts[gift_id]
+        if "remaining_count" in gift:
+            gift["remaining_count"] = max(0, gift["remaining_count"] - amount)
+
+    def remove(self, gift_id):
+        """Убирает подарок из списка доступных."""
+        self.gifts.pop(gift_id, None)
+
+    def flood(self, method, count=1):
+        """Следующие count вызовов метода получат 429 с retry_after."""
+        method = method.lower()
+        self.floods[method] = self.floods.get(method, 0) + count
+
+    def delivered_at(self, marker="NEW GIFT"):
+        """Возвращает gift_id → время первого сообщения с marker, в котором упоминается подарок."""
+        delivered = {}
+        for message in self.messages:
+            text = message.get("text") or ""
+            if marker not in text:
+                continue
+            for gift_id in self.appeared_at:
+                if gift_id not in delivered and f"<code>{gift_id}</code>" in text:
+                    delivered[gift_id] = message["time"]
+        return delivered
+
+    def total_calls(self):
+        """Возвращает общее количество вызовов API."""
+        return sum(self.calls.values())
+
+    # HTTP
+
+    def app(self):
+        """Создаёт aiohttp-приложение с эндпоинтами Bot API."""
+        app = web.Application()
+        app.router.add_route("*", "/bot{token}/{method}", self.handle)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.download)
+        return app
+
+    async def handle(self, request):
+        """Разбирает запрос и передаёт его обработчику метода."""
+        method = request.match_info["method"].lower()
+        self.calls[method] = self.calls.get(method, 0) + 1
+        params = dict(await request.post()) if request.can_read_body else {}  # Загруженные файлы — FileField
+        params.update(request.query)
+
+        if self.floods.get(method):
+            self.floods[method] -= 1
+            return self.too_many_requests()
+
+        handler = self.handlers.get(method)
+        if handler is None:
+            return self.error(404, "Not Found: method not found")
+        return await handler(params)
+
+    def ok(self, result):
+        """Успешный ответ Bot API."""
+        return web.json_response({"ok": True, "result": result})
+
+    def error(self, code, description, **parameters):
+        """Ответ Bot API с ошибкой."""
+        payload = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            payload["parameters"] = parameters
+        return web.json_response(payload, status=code)
+
+    def too_many_requests(self):
+        """Ответ 429 с retry_after, как при flood control."""
+        return self.error(429, f"Too Many Requests: retry after {self.retry_after}", retry_after=self.retry_after)
+
+    def make_sticker(self, file_id, set_name=None):
+        """Возвращает объект Sticker для file_id."""
+        sticker = {
+            "file_id": file_id,
+            "file_unique_id": self.unique_ids.get(file_id, f"u_{file_id}"),
+            "type": "regular",
+            "width": 512,
+            "height": 512,
+            "is_animated": True,
+            "is_video": False,
+        }
+        if set_name:
+            sticker["set_name"] = set_name
+        return sticker
+
+    async def download(self, request):
+        """Отдаёт содержимое файла по file_path из getFile."""
+        self.calls["download"] = self.calls.get("download", 0) + 1
+        unique_id = request.match_info["path"].rsplit("/", 1)[-1].split(".")[0]
+        if unique_id not in self.contents:
+            return web.Response(status=404)
+        return web.Response(body=self.contents[unique_id])
+
+    @staticmethod
+    def content_format(content):
+        """Определяет формат стикера по первым байтам файла."""
+        if content.startswith(b"\x1f\x8b"):
+            return "animated"
+        if content.startswith(b"\x1a\x45\xdf\xa3"):
+            return "video"
+        return "static"
+
+    def add_to_set(self, name, sticker, params):
+        """Добавляет в стикерпак копию стикера с новым file_id и тем же file_unique_id.
+
+        Возвращает текст ошибки, если формат не совпадает с файлом или file_id недействителен.
+        """
+        source = sticker["sticker"]
+        if source.startswith("attach://"):
+            content = params[source[len("attach://"):]].file.read()
+            unique_id = next((unique_id for unique_id, data in self.contents.items() if data == content),
+                             f"u_{hashlib.md5(content).hexdigest()}")
+            self.contents.setdefault(unique_id, content)
+        elif source in self.expired_file_ids:
+            return "Bad Request: wrong file identifier/HTTP URL specified"
+        else:
+            unique_id = self.unique_ids.get(source, f"u_{source}")
+        content = self.contents.get(unique_id)
+        if content is not None and sticker.get("format") != self.content_format(content):
+            return "Bad Request: STICKER_FILE_INVALID"
+        file_id = f"set_{unique_id}"
+        self.unique_ids[file_id] = unique_id
+        self.sticker_sets[name].append(self.make_sticker(file_id, name))
+        return None
+
+    def make_message(self, chat_id, reply_to_message_id=None, **content):
+        """Запоминает отправленное сообщение и возвращает объект Message."""
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        message = {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id), "type": "channel"},
+        }
+        message.update(content)
+        self.messages.append({
+            "message_id": message_id,
+            "chat_id": chat_id,
+            "reply_to_message_id": reply_to_message_id,
+            "time": time.monotonic(),
+            **content,
+        })
+        return message
+
+    def check_chat_rate(self, chat_id):
+        """Возвращает True, если отправка в чат превышает заданный лимит."""
+        if not self.chat_rate_limit:
+            return False
+        now = time.monotonic()
+        tokens, updated = self.chat_tokens.get(chat_id, (self.chat_burst, now))
+        tokens = min(self.chat_burst, tokens + (now - updated) * self.chat_rate_limit)
+        if tokens < 1:
+            self.chat_tokens[chat_id] = (tokens, now)
+            return True
+        self.chat_tokens[chat_id] = (tokens - 1, now)
+        return False
+
+    # Методы
+
+    async def get_available_gifts(self, params):
+        return self.ok({"gifts": list(self.gifts.values())})
+
+    async def get_sticker_set(self, params):
+        name = params.get("name")
+        if name not in self.sticker_sets:
+            return self.error(400, "Bad Request: STICKERSET_INVALID")
+        return self.ok({
+            "name": name,
+            "title": "Gift Stickers",
+            "sticker_type": "regular",
+            "stickers": self.sticker_sets[name],
+        })
+
+    async def create_new_sticker_set(self, params):
+        name = params.get("name")
+        if name in self.sticker_sets:
+            return self.error(400, "Bad Request: sticker set name is already occupied")
+        self.sticker_sets[name] = []
+        for sticker in json.loads(params.get("stickers", "[]")):
+            error = self.add_to_set(name, sticker, params)
+            if error:
+                del self.sticker_sets[name]
+                return self.error(400, error)
+        return self.ok(True)
+
+    async def add_sticker_to_set(self, params):
+        name = params.get("name")
+        if name not in self.sticker_sets:
+            return self.error(400, "Bad Request: STICKERSET_INVALID")
+        error = self.add_to_set(name, json.loads(params.get("sticker", "{}")), params)
+        if error:
+            return self.error(400, error)
+        return self.ok(True)
+
+    async def get_file(self, params):
+        file_id = params.get("file_id")
+        unique_id = self.unique_ids.get(file_id)
+        if unique_id not in self.contents:
+            return self.error(400, "Bad Request: invalid file_id")
+        return self.ok({
+            "file_id": file_id,
+            "file_unique_id": unique_id,
+            "file_size": len(self.contents[unique_id]),
+            "file_path": f"stickers/{unique_id}.tgs",
+        })
+
+    async def send_sticker(self, params):
+        chat_id = params.get("chat_id")
+        if self.check_chat_rate(chat_id):
+            return self.too_many_requests()
+        file_id = params.get("sticker")
+        return self.ok(self.make_message(chat_id, sticker=self.make_sticker(file_id)))
+
+    async def send_message(self, params):
+        chat_id = params.get("chat_id")
+        if self.check_chat_rate(chat_id):
+            return self.too_many_requests()
+        reply_to = params.get("reply_to_message_id")
+        if reply_to is None and params.get("reply_parameters"):
+            reply_to = json.loads(params["reply_parameters"]).get("message_id")
+        return self.ok(self.make_message(chat_id, reply_to_message_id=reply_to, text=params.get("text")))
+
+# Запускаем сервер
+async def start_server(api, host="127.0.0.1", port=8081):
+    """Запускает сервер и возвращает AppRunner для остановки."""
+    runner = web.AppRunner(api.app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+# Сценарий релиза
+async def run_scenario(api, args):
+    """Сценарий из командной строки: стартовые подарки, релиз и постепенная распродажа."""
+    api.release(args.initial)
+    logger.info(f"Доступно подарков: {len(api.gifts)}")
+    await asyncio.sleep(args.release_after)
+    released = api.release(args.release, total_count=args.supply)
+    logger.info(f"Релиз: добавлено {len(released)} подарков")
+    while any(api.gifts[gift_id].get("remaining_count") for gift_id in released if gift_id in api.gifts):
+        await asyncio.sleep(1)
+        for gift_id in released:
+            if gift_id in api.gifts:
+                api.drain(gift_id, random.randint(0, args.drain_rate))
+        if args.flood_every and random.random() < 1 / args.flood_every:
+            api.flood("sendMessage")
+    logger.info("Все подарки релиза раскуплены")
+
+# Основная функция
+async def main():
+    parser = argparse.ArgumentParser(description="Локальная замена Telegram Bot API для gifts.py")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--initial", type=int, default=20, help="Сколько подарков доступно с самого начала")
+    parser.add_argument("--release", type=int, default=300, help="Сколько подарков появится в релизе")
+    parser.add_argument("--release-after", type=float, default=15, help="Через сколько секунд начнётся релиз")
+    parser.add_argument("--supply", type=int, default=10000, help="Тираж каждого подарка из релиза")
+    parser.add_argument("--drain-rate", type=int, default=300, help="Максимум продаж одного подарка в секунду")
+    parser.add_argument("--chat-rate-limit", type=float, default=None, help="Лимит сообщений в секунду на чат")
+    parser.add_argument("--flood-every", type=float, default=0, help="В среднем раз в N секунд отвечать 429 на sendMessage")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s - %(levelname)s - %(message)s")
+    api = FakeBotAPI(chat_rate_limit=args.chat_rate_limit, retry_after=args.retry_after)
+    runner = await start_server(api, args.host, args.port)
+    logger.info(f"Bot API запущен на http://{args.host}:{args.port} (BOT_API_URL для gifts.py)")
+    try:
+        await run_scenario(api, args)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+if __name__ == '__main__':
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
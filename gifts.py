@@ -1,11 +1,35 @@
 import os
+import sys
+import zlib
 import json
+import mmap
+import struct
 import logging
+import logging.handlers
+import argparse
 import asyncio
+import bisect
+import hashlib
+import sqlite3
+import time
+import random
+import queue
+import atexit
+from array import array
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from typing import NamedTuple
+import aiohttp
+from aiohttp import web
 from aiogram import Bot, Dispatcher
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.methods import GetAvailableGifts, CreateNewStickerSet, AddStickerToSet, SendSticker, GetStickerSet
-from aiogram.types import Gifts, InputSticker, Message, StickerSet
-from aiogram.exceptions import TelegramAPIError
+from aiogram.types import FSInputFile, Gift, Gifts, InputSticker, Message, StickerSet
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
 
 # Загружаем переменные из .env
 from dotenv import load_dotenv
@@ -15,329 +39,2163 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = os.getenv("CHANNEL_ID")
 USER_ID = int(os.getenv("USER_ID"))
 BOT_USERNAME = os.getenv("BOT_USERNAME")
+BOT_API_URL = os.getenv("BOT_API_URL")  # Свой сервер Bot API (например, fake_bot_api.py); по умолчанию api.telegram.org
 
 STICKER_SET_NAME = f"GiftsNoticenew_by_{BOT_USERNAME}"  # Название стикерпака
 STICKERS_FILE = "stickers.json"  # Файл для хранения информации о стикерах
 KNOWN_GIFTS_FILE = "known_gifts.json"  # Файл для хранения информации о подарках
 NOTIFIED_GIFTS_FILE = "notified_gifts.json"  # Файл для хранения информации об уведомлениях
 GIFTS_STATE_FILE = "gifts_state.json"  # Файл для хранения текущего состояния подарков
+STATE_DB_FILE = os.getenv("STATE_DB_FILE", "gifts.db")  # База SQLite, заменившая JSON-файлы выше
+SNAPSHOT_LOG_FILE = os.getenv("SNAPSHOT_LOG_FILE", "snapshots.log")  # Журнал ответов GetAvailableGifts ("" — не вести)
+SNAPSHOT_KEYFRAME_INTERVAL = 500  # Через сколько записей журнала записывать снимок целиком
+MAX_STICKERS_PER_CREATE = 50  # Сколько стикеров принимает CreateNewStickerSet за один запрос
+STICKER_ASSETS_DIR = os.getenv("STICKER_ASSETS_DIR", "sticker_assets")  # Локальный кэш файлов стикеров подарков
+ASSET_DOWNLOAD_CONCURRENCY = 4  # Сколько стикеров скачивать одновременно
+SUBSCRIBERS_FILE = os.getenv("SUBSCRIBERS_FILE", "subscribers.json")  # Подписчики с фильтрами; CHANNEL_ID подписан всегда
 
-# Задержка между сообщениями
-DELAY_BETWEEN_MESSAGES = 2  # Задержка в 2 секунды
+# Уровни уведомлений о малом остатке, в процентах от тиража
+ALERT_LEVELS = sorted((float(level) for level in os.getenv("ALERT_LEVELS", "50,25,11,5,1").split(",")), reverse=True)
+RATE_ALERT_PER_MINUTE = float(os.getenv("RATE_ALERT_PER_MINUTE", 0))  # Уведомлять, если продаётся больше N в минуту (0 — выключено)
+RATE_ALERT_COOLDOWN = float(os.getenv("RATE_ALERT_COOLDOWN", 600))  # Не чаще одного уведомления о скорости на подарок, секунд
+SUPPLY_RATE_WINDOW = float(os.getenv("SUPPLY_RATE_WINDOW", 300))  # Окно для расчёта скорости продаж, секунд
+SUPPLY_HISTORY_SIZE = 64  # Сколько последних значений остатка хранится на подарок
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,
-    format="%(asctime)s - %(levelname)s - %(message)s",
-    handlers=[logging.FileHandler("gift_checker.log", encoding="utf-8"), logging.StreamHandler()]
-)
+# Надёжная очередь уведомлений (outbox)
+OUTBOX_BATCH = 100  # Сколько записей outbox забирать за раз
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", 1))  # Как часто проверять outbox без новых записей, секунд
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", 10))  # После скольких неудачных попыток отказаться
+OUTBOX_RETRY_DELAY = 5  # Начальная задержка повтора неотправленного уведомления, секунд
+OUTBOX_MAX_RETRY_DELAY = 600  # Максимальная задержка повтора, секунд
+OUTBOX_RETENTION = 7 * 24 * 3600  # Сколько хранить отправленные записи (и их ключи), секунд
+
+# Дайджесты: объединение событий в одно сообщение при большой очереди
+DIGEST_MIN_EVENTS = int(os.getenv("DIGEST_MIN_EVENTS", 4))  # С какой очереди событий чата слать дайджест (0 — выключено)
+DIGEST_WINDOW = float(os.getenv("DIGEST_WINDOW", 0))  # Сколько секунд собирать события перед отправкой
+MAX_MESSAGE_LENGTH = 4096  # Максимальная длина текста сообщения в Telegram
+
+# Задержка между сообщениями в один чат
+DELAY_BETWEEN_MESSAGES = float(os.getenv("DELAY_BETWEEN_MESSAGES", 2))  # Задержка в 2 секунды
+
+# Настройки опроса GetAvailableGifts
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", 2))  # Минимальный интервал между запросами, секунд
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", 30))  # Максимальный интервал в тихое время, секунд
+POLL_REQUESTS_PER_MINUTE = float(os.getenv("POLL_REQUESTS_PER_MINUTE", 30))  # Бюджет запросов в минуту
+POLL_BACKOFF = 1.5  # Во сколько раз растёт интервал после опроса без изменений
+
+# Настройки очереди уведомлений
+GLOBAL_RATE_LIMIT = float(os.getenv("GLOBAL_RATE_LIMIT", 30))  # Сообщений в секунду на весь бот (лимит Telegram)
+CHAT_BURST = int(os.getenv("CHAT_BURST", 3))  # Сколько сообщений подряд можно отправить в один чат без задержки
+NOTIFICATION_WORKERS = int(os.getenv("NOTIFICATION_WORKERS", 8))  # Количество воркеров отправки
+NOTIFICATION_QUEUE_SIZE = int(os.getenv("NOTIFICATION_QUEUE_SIZE", 1000))  # Максимальный размер очереди уведомлений
+
+# Повторы запросов к Bot API
+RETRY_BUDGETS = {"SendSticker": 5, "SendMessage": 5, "AddStickerToSet": 3, "CreateNewStickerSet": 3}  # Повторов на метод
+RETRY_DEFAULT_BUDGET = 2  # Повторов для остальных методов
+RETRY_BASE_DELAY = 0.5  # Начальная задержка повтора при сетевых ошибках, секунд
+RETRY_MAX_DELAY = 30  # Максимальная задержка повтора, секунд
+CIRCUIT_BREAKER_FAILURES = 5  # После скольких неудач подряд приостанавливать метод
+CIRCUIT_BREAKER_COOLDOWN = 60  # На сколько секунд приостанавливать метод
+
+# Несколько процессов (режим cluster): один опрашивает подарки, все отправляют уведомления своих чатов
+BOT_TOKENS = [token.strip() for token in os.getenv("BOT_TOKENS", "").split(",") if token.strip()]  # По процессу на токен
+DELIVERY_BOT_TOKEN = os.getenv("DELIVERY_BOT_TOKEN") or BOT_TOKEN  # Токен, которым этот процесс отправляет уведомления
+CLUSTER_NODE = int(os.getenv("CLUSTER_NODE", 0))  # Номер этого процесса
+CLUSTER_SIZE = int(os.getenv("CLUSTER_SIZE", 1))  # Сколько процессов отправляют уведомления
+LEADER_LEASE_TTL = float(os.getenv("LEADER_LEASE_TTL", 15))  # Через сколько секунд без продления лидерство переходит другому
+CLUSTER_RESTART_DELAY = 5  # Через сколько секунд перезапускать упавший процесс
+
+# Локальный HTTP-сервер (метрики Prometheus на /metrics, поток событий на /events и /ws, состояние на /snapshot)
+LOCAL_API_HOST = os.getenv("LOCAL_API_HOST", "127.0.0.1")
+LOCAL_API_PORT = int(os.getenv("LOCAL_API_PORT", 0))  # 0 — сервер не запускается
+TRACE_BUDGET = float(os.getenv("TRACE_BUDGET", 0))  # Выводить в лог трассировку циклов дольше N секунд (0 — выключено)
+EVENT_BUFFER_SIZE = int(os.getenv("EVENT_BUFFER_SIZE", 1000))  # Сколько последних событий хранить для переподключившихся клиентов
+EVENT_CLIENT_QUEUE_SIZE = int(os.getenv("EVENT_CLIENT_QUEUE_SIZE", 256))  # Очередь клиента, после которой он отключается
+EVENT_HEARTBEAT = 15  # Как часто проверять соединение с клиентом потока событий, секунд
+
+# Логирование
+LOG_FILE = os.getenv("LOG_FILE", "gift_checker.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # text или json (одна запись JSON на строку)
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", 10 * 1024 * 1024))  # Размер файла лога, после которого он ротируется
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", 5))  # Сколько старых файлов лога хранить
+LOG_RATE_LIMIT = int(os.getenv("LOG_RATE_LIMIT", 20))  # Сколько одинаковых INFO-сообщений писать за интервал (0 — без ограничения)
+LOG_RATE_INTERVAL = 60  # Интервал ограничения одинаковых сообщений, секунд
+
+# Форматируем записи лога в JSON
+class JsonFormatter(logging.Formatter):
+    """Форматирует запись в одну строку JSON с полями из extra."""
+
+    STANDARD = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        entry.update((key, value) for key, value in vars(record).items() if key not in self.STANDARD)
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+# Форматируем записи лога текстом
+class TextFormatter(logging.Formatter):
+    """Обычный текстовый формат, дописывающий число пропущенных одинаковых сообщений."""
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, "suppressed", 0)
+        return f"{text} (и ещё {suppressed} таких же сообщений пропущено)" if suppressed else text
+
+# Ограничиваем повторяющиеся сообщения
+class RateLimitFilter(logging.Filter):
+    """Пропускает не больше limit INFO-сообщений с одним шаблоном за interval секунд.
+
+    Сообщения группируются по шаблону (record.msg), поэтому при %-форматировании
+    «Стикер для подарка %s ...» для всех подарков считается одним сообщением.
+    Число отброшенных записей добавляется к первой пропущенной записи следующего интервала.
+    WARNING и выше не ограничиваются.
+    """
+
+    def __init__(self, limit, interval):
+        super().__init__()
+        self.limit = limit
+        self.interval = interval
+        self.windows = {}  # (логгер, шаблон) → [начало интервала, записано, отброшено]
+
+    def filter(self, record):
+        if not self.limit or record.levelno >= logging.WARNING:
+            return True
+        now = time.monotonic()
+        window = self.windows.setdefault((record.name, record.msg), [now, 0, 0])
+        if now - window[0] >= self.interval:
+            if window[2]:
+                record.suppressed = window[2]
+            window[:] = [now, 0, 0]
+        if window[1] >= self.limit:
+            window[2] += 1
+            return False
+        window[1] += 1
+        return True
+
+# Передаём записи лога в фоновый поток без форматирования
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """QueueHandler, который оставляет форматирование сообщения фоновому потоку.
+
+    Стандартный QueueHandler форматирует запись перед постановкой в очередь, чтобы её можно было
+    передать в другой процесс. Очередь здесь внутрипроцессная, поэтому запись передаётся как есть,
+    и подстановка аргументов, форматирование и запись на диск происходят в потоке QueueListener.
+    """
+
+    def prepare(self, record):
+        return record
+
+# Настройка логирования: запись в файл и консоль идёт из фонового потока, файл ротируется по размеру
+log_queue = queue.SimpleQueue()
+log_file = LOG_FILE
+if CLUSTER_SIZE > 1:
+    # У каждого процесса кластера свой файл: ротация одного файла из нескольких процессов небезопасна
+    log_name, log_ext = os.path.splitext(LOG_FILE)
+    log_file = f"{log_name}.{CLUSTER_NODE}{log_ext}"
+log_handlers = [
+    logging.handlers.RotatingFileHandler(log_file, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, encoding="utf-8"),
+    logging.StreamHandler(),
+]
+for handler in log_handlers:
+    handler.setFormatter(JsonFormatter() if LOG_FORMAT == "json" else TextFormatter("%(asctime)s - %(levelname)s - %(message)s"))
+log_listener = logging.handlers.QueueListener(log_queue, *log_handlers, respect_handler_level=True)
+queue_handler = LazyQueueHandler(log_queue)
+queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_INTERVAL))
+logging.basicConfig(level=logging.INFO, handlers=[queue_handler])
+log_listener.start()
+atexit.register(log_listener.stop)  # Дописываем оставшиеся в очереди записи при выходе
 logger = logging.getLogger(__name__)
 
-bot = Bot(token=BOT_TOKEN)
+# Создаём бота
+def create_bot(token):
+    """Создаёт бота с сессией на BOT_API_URL, если он задан."""
+    return Bot(token=token, session=AiohttpSession(api=TelegramAPIServer.from_base(BOT_API_URL)) if BOT_API_URL else None)
+
+bot = create_bot(BOT_TOKEN)  # Опрос подарков и стикерпак
+delivery_bot = create_bot(DELIVERY_BOT_TOKEN) if DELIVERY_BOT_TOKEN != BOT_TOKEN else bot  # Отправка уведомлений
 dp = Dispatcher()
 
+replay_mode = False  # Воспроизведение журнала снимков: без запросов к Telegram
 known_gifts = {}
 stickers_data = {}  # Словарь для хранения информации о стикерах
 notified_gifts = {"threshold": {}, "sold_out": {}}  # Словарь для хранения информации об уведомлениях
+gifts_state = {}  # Текущее состояние подарков (апгрейды, остаток)
 
-# Инициализация файла для уведомлений
-def initialize_notified_gifts():
-    """Инициализирует файл для хранения уведомлений, если он не существует."""
-    if not os.path.exists(NOTIFIED_GIFTS_FILE):
-        with open(NOTIFIED_GIFTS_FILE, "w") as f:
-            json.dump({"threshold": {}, "sold_out": {}}, f)  # Создаём файл с пустой структурой
-
-# Загружаем данные о подарках из файла
-def load_known_gifts():
-    """Загружает данные о подарках из known_gifts.json."""
-    if os.path.exists(KNOWN_GIFTS_FILE):
-        with open(KNOWN_GIFTS_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-# Сохраняем данные о подарках в файл
-def save_known_gifts():
-    """Сохраняет данные о подарках в known_gifts.json."""
-    with open(KNOWN_GIFTS_FILE, "w") as f:
-        json.dump(known_gifts, f, indent=4)
-
-# Загружаем данные о стикерах из файла
-def load_stickers_data():
-    """Загружает данные о стикерах из stickers.json."""
-    if os.path.exists(STICKERS_FILE):
-        with open(STICKERS_FILE, "r") as f:
-            return json.load(f)
-    return {}
-
-# Сохраняем данные о стикерах в файл
-def save_stickers_data():
-    """Сохраняет данные о стикерах в stickers.json."""
-    with open(STICKERS_FILE, "w") as f:
-        json.dump(stickers_data, f, indent=4)
-
-# Загружаем данные об уведомлениях из файла
-def load_notified_gifts():
-    """Загружает данные об уведомлениях из notified_gifts.json."""
-    if os.path.exists(NOTIFIED_GIFTS_FILE):
-        with open(NOTIFIED_GIFTS_FILE, "r") as f:
-            return json.load(f)
-    return {"threshold": {}, "sold_out": {}}  # Возвращаем пустую структуру, если файла нет
-
-# Сохраняем данные об уведомлениях в файл
-def save_notified_gifts():
-    """Сохраняет данные об уведомлениях в notified_gifts.json."""
-    with open(NOTIFIED_GIFTS_FILE, "w") as f:
-        json.dump(notified_gifts, f, indent=4)
-
-# Загружаем текущее состояние подарков из файла
-def load_gifts_state():
-    """Загружает текущее состояние подарков из файла."""
-    if os.path.exists(GIFTS_STATE_FILE):
-        with open(GIFTS_STATE_FILE, "r") as f:
-            return json.load(f)
-    return {}  # Возвращаем пустой словарь, если файла нет
-
-# Сохраняем текущее состояние подарков в файл
-def save_gifts_state(gifts_state):
-    """Сохраняет текущее состояние подарков в файл."""
-    with open(GIFTS_STATE_FILE, "w") as f:
-        json.dump(gifts_state, f, indent=4)
+# Метрика-счётчик
+class Counter:
+    """Счётчик Prometheus с метками."""
 
-# Проверяем существование стикерпака
-async def sticker_set_exists(name):
-    """Проверяет существование стикерпака."""
+    kind = "counter"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.values = {}  # кортеж пар (метка, значение) → число
+
+    def inc(self, amount=1, **labels):
+        """Увеличивает счётчик."""
+        key = tuple(sorted(labels.items()))
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        """Возвращает строки с текущими значениями."""
+        return [f"{self.name}{format_labels(key)} {value}" for key, value in self.values.items()]
+
+# Метрика-значение
+class Gauge:
+    """Текущее значение, которое считывается функцией в момент запроса метрик."""
+
+    kind = "gauge"
+
+    def __init__(self, name, help_text, read):
+        self.name = name
+        self.help_text = help_text
+        self.read = read
+
+    def samples(self):
+        """Возвращает строку с текущим значением."""
+        return [f"{self.name} {self.read()}"]
+
+# Метрика-гистограмма
+class Histogram:
+    """Гистограмма Prometheus с метками."""
+
+    kind = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, name, help_text, buckets=default_buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.values = {}  # метки → [счётчики по корзинам, сумма, количество]
+
+    def observe(self, value, **labels):
+        """Добавляет наблюдение."""
+        key = tuple(sorted(labels.items()))
+        data = self.values.get(key)
+        if data is None:
+            data = self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                data[0][i] += 1
+        data[1] += value
+        data[2] += 1
+
+    def samples(self):
+        """Возвращает строки корзин, суммы и количества."""
+        lines = []
+        for key, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                lines.append(f"{self.name}_bucket{format_labels(key + (('le', bound),))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{self.name}_sum{format_labels(key)} {total}")
+            lines.append(f"{self.name}_count{format_labels(key)} {count}")
+        return lines
+
+# Форматируем метки метрики
+def format_labels(key):
+    """Возвращает метки в формате Prometheus: {name="value",...}."""
+    if not key:
+        return ""
+    return "{" + ",".join(f'{name}="{value}"' for name, value in key) + "}"
+
+# Собираем все метрики в текстовом формате Prometheus
+def render_metrics():
+    """Возвращает все метрики в текстовом формате Prometheus."""
+    lines = []
+    for metric in METRICS:
+        lines.append(f"# HELP {metric.name} {metric.help_text}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+stage_seconds = Histogram("gifts_stage_seconds", "Длительность этапов цикла: fetch, parse, diff, process, persist, deliver")
+cycle_seconds = Histogram("gifts_cycle_seconds", "Длительность цикла от запроса подарков до сохранения состояния")
+polls_total = Counter("gifts_polls_total", "Запросы GetAvailableGifts по результату: changed, unchanged, error")
+telegram_request_seconds = Histogram("gifts_telegram_request_seconds", "Длительность запросов к Bot API по методам")
+telegram_errors_total = Counter("gifts_telegram_errors_total", "Ошибки Bot API по методам и типам")
+telegram_flood_waits_total = Counter("gifts_telegram_flood_waits_total", "Ответы 429 (flood wait) по методам")
+telegram_retries_total = Counter("gifts_telegram_retries_total", "Повторы запросов к Bot API по методам")
+notifications_total = Counter("gifts_notifications_total", "Уведомления по результату: sent, failed")
+notifications_coalesced_total = Counter("gifts_notifications_coalesced_total", "События, объединённые в дайджесты")
+detection_latency_seconds = Histogram("gifts_detection_latency_seconds", "Время от получения изменения до доставки уведомления")
+METRICS = [stage_seconds, cycle_seconds, polls_total, telegram_request_seconds, telegram_errors_total,
+           telegram_flood_waits_total, telegram_retries_total, notifications_total, notifications_coalesced_total,
+           detection_latency_seconds]
+
+# Трассировка одного цикла
+class CycleTrace:
+    """Собирает спаны этапов одного цикла опроса и пишет их в метрики.
+
+    Если цикл длился дольше TRACE_BUDGET, спаны выводятся в лог одной строкой JSON.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.wall_started = time.time()
+        self.spans = []  # (этап, начало от старта цикла, длительность)
+
+    @contextmanager
+    def span(self, stage):
+        """Замеряет этап цикла."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - started
+            self.spans.append((stage, started - self.started, duration))
+            stage_seconds.observe(duration, stage=stage)
+
+    def finish(self):
+        """Завершает цикл: записывает его длительность и при превышении бюджета выводит спаны."""
+        duration = time.perf_counter() - self.started
+        cycle_seconds.observe(duration)
+        if TRACE_BUDGET and duration > TRACE_BUDGET:
+            trace = {
+                "started": self.wall_started,
+                "duration_ms": round(duration * 1000, 1),
+                "spans": [{"stage": stage, "offset_ms": round(offset * 1000, 1), "duration_ms": round(span * 1000, 1)}
+                          for stage, offset, span in self.spans],
+            }
+            logger.warning("Цикл превысил бюджет %s с: %s", TRACE_BUDGET, json.dumps(trace, ensure_ascii=False))
+
+# Время обнаружения изменений, которые обрабатываются в текущем цикле
+detected_at = ContextVar("detected_at", default=None)
+
+# Метрики запросов к Bot API
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет длительность запросов к Bot API и считает ошибки по методам."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            telegram_flood_waits_total.inc(method=name)
+            raise
+        except TelegramAPIError as e:
+            telegram_errors_total.inc(method=name, error=type(e).__name__)
+            raise
+        finally:
+            telegram_request_seconds.observe(time.perf_counter() - started, method=name)
+
+# Ошибка: запросы к методу временно не отправляются
+class TelegramCircuitOpen(TelegramAPIError):
+    """Метод отключён автоматом после серии неудачных запросов."""
+
+# Повторы запросов к Bot API
+class RetryMiddleware(BaseRequestMiddleware):
+    """Повторяет запросы к Bot API в одном месте для всех методов.
+
+    На flood wait (TelegramRetryAfter) ставится на паузу только «полоса» запроса: чат, если у метода
+    есть chat_id, иначе сам метод. После паузы накопившиеся запросы полосы идут по одному
+    с интервалом DELAY_BETWEEN_MESSAGES, чтобы ждавшие не получили 429 все разом. Сетевые ошибки и ошибки сервера повторяются с экспоненциальной
+    задержкой со случайным разбросом. Число повторов ограничено RETRY_BUDGETS. Если метод
+    CIRCUIT_BREAKER_FAILURES раз подряд не удалось выполнить, запросы к нему не отправляются
+    CIRCUIT_BREAKER_COOLDOWN секунд.
+    """
+
+    def __init__(self):
+        self.lanes = {}  # полоса → время (loop.time()), до которого она на паузе
+        self.lane_locks = {}  # полоса → замок, через который идут запросы после flood wait
+        self.lane_waiters = {}  # полоса → сколько запросов ждут замка
+        self.failures = {}  # метод → неудачи подряд
+        self.open_until = {}  # метод → время, до которого автомат разомкнут
+
+    @staticmethod
+    def lane(name, method):
+        """Возвращает полосу запроса: чат или метод."""
+        chat_id = getattr(method, "chat_id", None)
+        return f"chat:{chat_id}" if chat_id is not None else f"method:{name}"
+
+    async def wait_lane(self, lane):
+        """Ждёт окончания паузы полосы."""
+        loop = asyncio.get_running_loop()
+        while (delay := self.lanes.get(lane, 0) - loop.time()) > 0:
+            await asyncio.sleep(delay)
+
+    async def send(self, make_request, bot, method, lane):
+        """Отправляет запрос, соблюдая паузу полосы и очерёдность после flood wait."""
+        await self.wait_lane(lane)
+        lock = self.lane_locks.get(lane)
+        if lock is None:
+            return await make_request(bot, method)
+        self.lane_waiters[lane] = self.lane_waiters.get(lane, 0) + 1
+        try:
+            async with lock:
+                await self.wait_lane(lane)
+                try:
+                    return await make_request(bot, method)
+                finally:
+                    await asyncio.sleep(DELAY_BETWEEN_MESSAGES)
+        finally:
+            self.lane_waiters[lane] -= 1
+            # Очередь разобрана: запросы полосы снова идут параллельно
+            if not self.lane_waiters[lane] and self.lane_locks.get(lane) is lock and not lock.locked():
+                del self.lane_locks[lane]
+                del self.lane_waiters[lane]
+
+    def record_failure(self, name):
+        """Считает неудачу метода и при необходимости размыкает автомат."""
+        self.failures[name] = self.failures.get(name, 0) + 1
+        if self.failures[name] >= CIRCUIT_BREAKER_FAILURES:
+            self.open_until[name] = asyncio.get_running_loop().time() + CIRCUIT_BREAKER_COOLDOWN
+            self.failures[name] = 0
+            logger.error("Запросы %s приостановлены на %s секунд после серии ошибок.", name, CIRCUIT_BREAKER_COOLDOWN)
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        loop = asyncio.get_running_loop()
+        if self.open_until.get(name, 0) > loop.time():
+            raise TelegramCircuitOpen(method=method, message=f"Запросы {name} временно приостановлены")
+
+        lane = self.lane(name, method)
+        budget = RETRY_BUDGETS.get(name, RETRY_DEFAULT_BUDGET)
+        attempt = 0
+        while True:
+            try:
+                result = await self.send(make_request, bot, method, lane)
+            except TelegramRetryAfter as e:
+                pause_until = loop.time() + e.retry_after
+                self.lanes[lane] = max(self.lanes.get(lane, 0), pause_until)
+                self.lane_locks.setdefault(lane, asyncio.Lock())
+                if attempt >= budget:
+                    self.record_failure(name)
+                    raise
+                logger.warning("Лимит запросов %s превышен. Полоса %s ждёт %s секунд...", name, lane, e.retry_after)
+            except (TelegramNetworkError, TelegramServerError) as e:
+                if attempt >= budget:
+                    self.record_failure(name)
+                    raise
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+                logger.warning("Ошибка запроса %s: %s. Повтор через %.1f секунд...", name, e, delay)
+                await asyncio.sleep(delay)
+            else:
+                self.failures[name] = 0
+                return result
+            attempt += 1
+            telegram_retries_total.inc(method=name)
+
+# Повторы снаружи, метрики внутри: так метрики видят каждую попытку
+for client in (bot,) if delivery_bot is bot else (bot, delivery_bot):
+    client.session.middleware(RetryMiddleware())
+    client.session.middleware(TelegramMetricsMiddleware())
+
+# Поток событий для локальных клиентов
+class EventStream:
+    """Раздаёт события о подарках локальным клиентам сразу при обнаружении, до отправки в Telegram.
+
+    У событий сквозной номер seq. Последние EVENT_BUFFER_SIZE событий хранятся в памяти, и
+    переподключившийся клиент получает пропущенные, передав последний полученный id
+    (параметр since или заголовок Last-Event-ID). Если пропущено больше, чем хранится, или бот
+    перезапускался, клиент получает событие reset и должен перечитать /snapshot. Очередь
+    клиента ограничена EVENT_CLIENT_QUEUE_SIZE: медленного клиента отключают событием overflow,
+    чтобы не копить для него память и не задерживать остальных.
+    """
+
+    def __init__(self, buffer_size=EVENT_BUFFER_SIZE, queue_size=EVENT_CLIENT_QUEUE_SIZE):
+        self.stream_id = f"{int(time.time())}-{os.getpid()}"  # Новый при каждом запуске: seq начинается заново
+        self.seq = 0
+        self.buffer = deque(maxlen=buffer_size)
+        self.queue_size = queue_size
+        self.clients = set()  # Очереди подключённых клиентов
+
+    def event_id(self, seq):
+        """Возвращает id события для клиента: поток и seq."""
+        return f"{self.stream_id}:{seq}"
+
+    def publish(self, event_type, data):
+        """Отправляет событие всем подключённым клиентам."""
+        self.seq += 1
+        event = {"id": self.event_id(self.seq), "seq": self.seq, "type": event_type, "time": time.time(), **data}
+        self.buffer.append(event)
+        for queue in list(self.clients):
+            try:
+                queue.put_nowait(event)
+            except asyncio.QueueFull:
+                # Клиент не успевает: очищаем его очередь и оставляем в ней только сигнал отключения
+                self.clients.discard(queue)
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def subscribe(self, last_event_id=None):
+        """Подключает клиента. Возвращает его очередь и события, пропущенные после last_event_id."""
+        queue = asyncio.Queue(self.queue_size)
+        self.clients.add(queue)
+        if not last_event_id:
+            return queue, []
+        stream_id, _, seq = last_event_id.rpartition(":")
+        try:
+            seq = int(seq)
+        except ValueError:
+            seq = -1
+        oldest = self.buffer[0]["seq"] if self.buffer else self.seq + 1
+        if (stream_id and stream_id != self.stream_id) or not oldest - 1 <= seq <= self.seq:
+            return queue, [{"id": self.event_id(self.seq), "seq": self.seq, "type": "reset"}]
+        return queue, [event for event in self.buffer if event["seq"] > seq]
+
+    def unsubscribe(self, queue):
+        """Отключает клиента."""
+        self.clients.discard(queue)
+
+event_stream = EventStream()
+METRICS.append(Gauge("gifts_event_stream_clients", "Клиенты, подключённые к потоку событий", lambda: len(event_stream.clients)))
+
+# Отдаём метрики по HTTP
+async def handle_metrics(request):
+    """Отдаёт метрики в текстовом формате Prometheus."""
+    return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+# Отдаём текущее состояние подарков
+async def handle_snapshot(request):
+    """Отдаёт состояние подарков в памяти и id последнего события, с которого продолжать поток."""
+    return web.json_response({
+        "id": event_stream.event_id(event_stream.seq),
+        "seq": event_stream.seq,
+        "gifts": gifts_state,
+        "known_gifts": known_gifts
+    })
+
+# Передаём события клиенту
+async def pump_events(request, send):
+    """Передаёт клиенту пропущенные и новые события через send(event); send(None) — проверка соединения."""
+    queue, backlog = event_stream.subscribe(request.query.get("since") or request.headers.get("Last-Event-ID"))
     try:
-        await bot(GetStickerSet(name=name))
-        return True
-    except Exception as e:
-        logger.error(f"Ошибка при проверке существования стикерпака: {e}")
-        return False
+        for event in backlog:
+            await send(event)
+        last_id = backlog[-1]["id"] if backlog else None
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), EVENT_HEARTBEAT)
+            except asyncio.TimeoutError:
+                await send(None)
+                continue
+            if event is None:
+                logger.warning("Клиент потока событий не успевает и отключён.")
+                await send({"id": last_id, "type": "overflow"})
+                return
+            await send(event)
+            last_id = event["id"]
+    except ConnectionResetError:
+        pass
+    finally:
+        event_stream.unsubscribe(queue)
 
-# Получаем актуальный file_id стикера из стикерпака
-async def get_sticker_file_id(sticker_set_name, sticker_emoji):
-    """Получает file_id стикера из стикерпака по emoji."""
+# Поток событий через Server-Sent Events
+async def handle_sse(request):
+    """Отдаёт поток событий в формате text/event-stream."""
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+    await response.prepare(request)
+
+    async def send(event):
+        if event is None:
+            await response.write(b": ping\n\n")
+            return
+        data = json.dumps(event, ensure_ascii=False)
+        event_id = f"id: {event['id']}\n" if event.get("id") else ""
+        await response.write(f"{event_id}event: {event['type']}\ndata: {data}\n\n".encode())
+
+    await pump_events(request, send)
+    return response
+
+# Поток событий через WebSocket
+async def handle_websocket(request):
+    """Отдаёт поток событий через WebSocket, по одному JSON-сообщению на событие."""
+    ws = web.WebSocketResponse(heartbeat=EVENT_HEARTBEAT)
+    await ws.prepare(request)
+
+    async def send(event):
+        if event is not None:
+            await ws.send_str(json.dumps(event, ensure_ascii=False))
+
+    async def read_until_closed():
+        # Сообщения клиента читаем только ради закрытия соединения
+        async for _ in ws:
+            pass
+
+    tasks = {asyncio.create_task(pump_events(request, send)), asyncio.create_task(read_until_closed())}
     try:
-        sticker_set = await bot(GetStickerSet(name=sticker_set_name))
-        for sticker in sticker_set.stickers:
-            if sticker.emoji == sticker_emoji:
-                return sticker.file_id
-        return None
-    except Exception as e:
-        logger.error(f"Ошибка при получении стикерпака: {e}")
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await ws.close()
+    return ws
+
+# Запускаем локальный HTTP-сервер
+async def start_local_api():
+    """Запускает локальный HTTP-сервер, если задан LOCAL_API_PORT. Возвращает AppRunner или None."""
+    if not LOCAL_API_PORT:
         return None
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    app.router.add_get("/snapshot", handle_snapshot)
+    app.router.add_get("/events", handle_sse)
+    app.router.add_get("/ws", handle_websocket)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, LOCAL_API_HOST, LOCAL_API_PORT).start()
+    logger.info("Метрики доступны на http://%s:%s/metrics, события — на /events и /ws", LOCAL_API_HOST, LOCAL_API_PORT)
+    return runner
+
+# Хранилище состояния
+class StateStore:
+    """Хранит состояние бота в SQLite (режим WAL).
+
+    Изменения копятся в памяти через stage() и записываются одной транзакцией в commit(),
+    который выполняется в отдельном потоке, чтобы не блокировать цикл событий.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = None
+        self.pending = {}  # (namespace, key) → значение; None означает удаление
+        self.pending_outbox = []  # Новые записи outbox, которые запишутся вместе с состоянием
+        self.lock = asyncio.Lock()
+
+    def open(self):
+        """Открывает базу и создаёт таблицы, если их нет."""
+        self.conn = sqlite3.connect(self.path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (namespace, key)) WITHOUT ROWID"
+            )
+            self.conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS outbox ("
+                "id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT NOT NULL UNIQUE, chat_id TEXT NOT NULL, "
+                "sticker_file_id TEXT NOT NULL, text TEXT NOT NULL, detected_at REAL, created_at REAL NOT NULL, "
+                "status TEXT NOT NULL DEFAULT 'pending', attempts INTEGER NOT NULL DEFAULT 0, "
+                "next_attempt_at REAL NOT NULL DEFAULT 0, sticker_message_id INTEGER, delivered_at REAL, "
+                "sticker_unique_id TEXT, chat_hash INTEGER NOT NULL DEFAULT 0)"
+            )
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_pending ON outbox (status, next_attempt_at)")
+            self.conn.execute("CREATE INDEX IF NOT EXISTS outbox_chat ON outbox (chat_id, status)")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+            )
+            self._upgrade_outbox()
+
+    def _upgrade_outbox(self):
+        """Добавляет в outbox, созданный прежней версией, колонки для нескольких процессов."""
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(outbox)")}
+        if "chat_hash" in columns:
+            return
+        self.conn.execute("ALTER TABLE outbox ADD COLUMN sticker_unique_id TEXT")
+        self.conn.execute("ALTER TABLE outbox ADD COLUMN chat_hash INTEGER NOT NULL DEFAULT 0")
+        rows = self.conn.execute("SELECT id, chat_id FROM outbox WHERE status = 'pending'").fetchall()
+        self.conn.executemany("UPDATE outbox SET chat_hash = ? WHERE id = ?",
+                              [(chat_hash(chat_id), outbox_id) for outbox_id, chat_id in rows])
+
+    def close(self):
+        """Закрывает базу."""
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def load(self, namespace):
+        """Загружает все записи пространства имён в словарь."""
+        rows = self.conn.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,))
+        return {key: json.loads(value) for key, value in rows}
+
+    def stage(self, namespace, key, value):
+        """Запоминает изменение до следующего commit(). value=None удаляет запись."""
+        self.pending[(namespace, key)] = value
+
+    def stage_outbox(self, key, chat_id, sticker_file_id, text, detected_at=None, sticker_unique_id=None):
+        """Запоминает новую запись outbox до следующего commit(). Запись с уже известным key пропускается."""
+        self.pending_outbox.append((key, str(chat_id), sticker_file_id, text, detected_at, time.time(),
+                                    sticker_unique_id, chat_hash(chat_id)))
+
+    async def commit(self):
+        """Атомарно записывает все накопленные изменения."""
+        if not self.pending and not self.pending_outbox:
+            return
+        batch, self.pending = self.pending, {}
+        outbox, self.pending_outbox = self.pending_outbox, []
+        try:
+            await self.run(self._write, batch, outbox)
+        except Exception:
+            # Возвращаем пачку, чтобы записать её со следующим commit(); более новые значения остаются
+            self.pending = {**batch, **self.pending}
+            self.pending_outbox = outbox + self.pending_outbox
+            raise
+
+    def discard(self):
+        """Отбрасывает накопленные и ещё не записанные изменения."""
+        self.pending = {}
+        self.pending_outbox = []
+
+    async def run(self, func, *args, **kwargs):
+        """Выполняет операцию с базой в отдельном потоке, по одной за раз."""
+        async with self.lock:
+            return await asyncio.to_thread(func, *args, **kwargs)
+
+    def _write(self, batch, outbox=()):
+        """Записывает пачку изменений одной транзакцией."""
+        upserts = [(namespace, key, json.dumps(value, ensure_ascii=False))
+                   for (namespace, key), value in batch.items() if value is not None]
+        deletes = [(namespace, key) for (namespace, key), value in batch.items() if value is None]
+        with self.conn:
+            self.conn.executemany(
+                "INSERT INTO state (namespace, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT (namespace, key) DO UPDATE SET value = excluded.value",
+                upserts
+            )
+            self.conn.executemany("DELETE FROM state WHERE namespace = ? AND key = ?", deletes)
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO outbox (key, chat_id, sticker_file_id, text, detected_at, created_at, "
+                "sticker_unique_id, chat_hash) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                outbox
+            )
+
+    def load_outbox(self, now, limit, node=0, size=1):
+        """Возвращает неотправленные записи outbox, которые пора отправить.
+
+        Берутся чаты limit самых старых записей, и для каждого из них — все его записи,
+        чтобы события одного чата можно было объединить в дайджест. Из нескольких процессов
+        каждый получает только чаты, у которых chat_hash % size == node.
+        """
+        return self.conn.execute(
+            "SELECT id, chat_id, sticker_file_id, text, detected_at, attempts, sticker_message_id, sticker_unique_id "
+            "FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? AND chat_id IN ("
+            "SELECT chat_id FROM outbox WHERE status = 'pending' AND next_attempt_at <= ? AND chat_hash % ? = ? "
+            "ORDER BY id LIMIT ?) ORDER BY id",
+            (now, now, size, node, limit)
+        ).fetchall()
+
+    def update_outbox(self, outbox_ids, **fields):
+        """Обновляет поля записей outbox."""
+        assignments = ", ".join(f"{name} = ?" for name in fields)
+        placeholders = ", ".join("?" * len(outbox_ids))
+        with self.conn:
+            self.conn.execute(f"UPDATE outbox SET {assignments} WHERE id IN ({placeholders})",
+                              (*fields.values(), *outbox_ids))
+
+    def acquire_lease(self, name, owner, ttl):
+        """Берёт или продлевает аренду name, если она свободна, истекла или уже принадлежит owner."""
+        now = time.time()
+        with self.conn:
+            self.conn.execute(
+                "INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at "
+                "WHERE leases.owner = excluded.owner OR leases.expires_at < ?",
+                (name, owner, now + ttl, now)
+            )
+            (holder,) = self.conn.execute("SELECT owner FROM leases WHERE name = ?", (name,)).fetchone()
+        return holder == owner
+
+    def release_lease(self, name, owner):
+        """Освобождает аренду, если она принадлежит owner."""
+        with self.conn:
+            self.conn.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+    def purge_outbox(self, before):
+        """Удаляет отправленные и окончательно не отправленные записи старше before."""
+        with self.conn:
+            self.conn.execute("DELETE FROM outbox WHERE status != 'pending' AND created_at < ?", (before,))
+
+    def migrate_from_json(self):
+        """Однократно переносит данные из старых JSON-файлов в базу."""
+        if self.conn.execute("SELECT 1 FROM meta WHERE key = 'json_migrated'").fetchone():
+            return
+        sources = [
+            (KNOWN_GIFTS_FILE, lambda data: {"known_gifts": data}),
+            (STICKERS_FILE, lambda data: {"stickers": data}),
+            (NOTIFIED_GIFTS_FILE, lambda data: {f"notified:{kind}": marks for kind, marks in data.items()}),
+            (GIFTS_STATE_FILE, lambda data: {"gifts_state": data}),
+        ]
+        batch = {}
+        for path, to_namespaces in sources:
+            if not os.path.exists(path):
+                continue
+            try:
+                with open(path, "r") as f:
+                    data = json.load(f)
+            except (OSError, ValueError) as e:
+                logger.error("Не удалось прочитать %s при миграции: %s", path, e)
+                continue
+            for namespace, records in to_namespaces(data).items():
+                for key, value in records.items():
+                    batch[(namespace, key)] = value
+            logger.info("Данные из %s перенесены в %s.", path, self.path)
+        self._write(batch)
+        with self.conn:
+            self.conn.execute("INSERT INTO meta (key, value) VALUES ('json_migrated', ?)", (str(int(time.time())),))
+
+state_store = StateStore(STATE_DB_FILE)
+
+# Считаем хэш чата для распределения по процессам
+def chat_hash(chat_id):
+    """Возвращает crc32 от chat_id: уведомления чата отправляет процесс chat_hash % CLUSTER_SIZE."""
+    return zlib.crc32(str(chat_id).encode())
+
+# Загружаем состояние из базы
+def load_state():
+    """Загружает известные подарки, стикеры, уведомления и состояние подарков из базы."""
+    global known_gifts, stickers_data, notified_gifts, gifts_state
+    known_gifts = state_store.load("known_gifts")
+    stickers_data = state_store.load("stickers")
+    notified_gifts = {kind: state_store.load(f"notified:{kind}") for kind in ("threshold", "sold_out")}
+    sticker_assets.index = state_store.load("sticker_assets")
+    # Раньше порог был один (11%) и отмечался как True: переводим такие отметки в уровень 11%
+    for gift_id, level in notified_gifts["threshold"].items():
+        if level is True:
+            notified_gifts["threshold"][gift_id] = 11.0
+    gifts_state = state_store.load("gifts_state")
+
+# Сохраняем данные о подарке
+def save_known_gift(gift_id):
+    """Запоминает данные о подарке для записи в базу."""
+    state_store.stage("known_gifts", gift_id, known_gifts[gift_id])
+
+# Сохраняем file_id стикера подарка
+def save_gift_sticker(gift_id, file_id):
+    """Запоминает file_id стикера подарка в памяти и для записи в базу."""
+    stickers_data[gift_id] = file_id
+    state_store.stage("stickers", gift_id, file_id)
+
+# Сохраняем отметку об уведомлении
+def save_notified_gift(kind, gift_id, value=True):
+    """Отмечает, что уведомление kind по подарку отправлено. Для порогов value — достигнутый уровень."""
+    notified_gifts[kind][gift_id] = value
+    state_store.stage(f"notified:{kind}", gift_id, value)
+
+# Сохраняем состояние подарка
+def save_gift_state(gift_id):
+    """Запоминает текущее состояние подарка для записи в базу."""
+    state_store.stage("gifts_state", gift_id, gifts_state[gift_id])
+
+# Индекс стикерпака в памяти
+class StickerSetIndex:
+    """Хранит содержимое стикерпака в памяти, чтобы не запрашивать его по каждому подарку.
+
+    Стикеры индексируются по file_unique_id: в отличие от emoji он уникален для каждого подарка.
+    file_id у каждого бота свой, поэтому индекс строится запросами от имени client.
+    """
+
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.exists = None  # None — стикерпак ещё не запрашивали
+        self.file_ids = []  # file_id стикеров в порядке их следования в стикерпаке
+        self.by_unique_id = {}  # file_unique_id → file_id
+        self.unique_ids = {}  # file_id → file_unique_id
+
+    async def refresh(self):
+        """Загружает стикерпак одним запросом GetStickerSet и перестраивает индекс."""
+        try:
+            sticker_set = await self.client(GetStickerSet(name=self.name))
+        except TelegramBadRequest as e:
+            # Telegram отвечает STICKERSET_INVALID, если стикерпака нет
+            logger.info("Стикерпак '%s' не найден: %s", self.name, e)
+            self.exists = False
+            self.file_ids = []
+            self.by_unique_id = {}
+            self.unique_ids = {}
+            return
+        self.exists = True
+        self.file_ids = [sticker.file_id for sticker in sticker_set.stickers]
+        self.by_unique_id = {sticker.file_unique_id: sticker.file_id for sticker in sticker_set.stickers}
+        self.unique_ids = {sticker.file_id: sticker.file_unique_id for sticker in sticker_set.stickers}
+
+    def get(self, file_unique_id):
+        """Возвращает file_id стикера из стикерпака по file_unique_id."""
+        return self.by_unique_id.get(file_unique_id)
+
+    def unique_id(self, file_id):
+        """Возвращает file_unique_id стикера из стикерпака по file_id."""
+        return self.unique_ids.get(file_id)
+
+    def __len__(self):
+        return len(self.file_ids)
+
+sticker_set_index = StickerSetIndex(STICKER_SET_NAME, bot)
+delivery_sticker_index = StickerSetIndex(STICKER_SET_NAME, delivery_bot) if delivery_bot is not bot else sticker_set_index
+delivery_sticker_lock = asyncio.Lock()
+
+# Определяем формат стикера по флагам
+def sticker_format(sticker):
+    """Возвращает формат стикера для InputSticker: static, animated или video."""
+    if sticker.is_video:
+        return "video"
+    if sticker.is_animated:
+        return "animated"
+    return "static"
+
+# Определяем формат стикера по содержимому файла
+def detect_sticker_format(data):
+    """Возвращает формат стикера по первым байтам файла или None, если формат не распознан."""
+    if data[:2] == b"\x1f\x8b":
+        return "animated"  # TGS — сжатый gzip Lottie
+    if data[:4] == b"\x1a\x45\xdf\xa3":
+        return "video"  # WEBM
+    if (data[:4] == b"RIFF" and data[8:12] == b"WEBP") or data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "static"
+    return None
+
+# Локальный кэш файлов стикеров
+class StickerAssets:
+    """Хранит файлы стикеров подарков на диске под их file_unique_id и помнит их file_id в стикерпаках.
+
+    Стикер добавляется в стикерпак по file_id: того же стикера, уже загруженного в какой-либо
+    стикерпак, или самого подарка, с форматом из флагов стикера. Файл каждого стикера скачивается
+    через GetFile один раз в фоновой задаче, уже после загрузки в стикерпак, и не задерживает
+    уведомления; если формат по содержимому файла расходится с флагами, дальше используется он.
+    Если Telegram отклонил file_id (например, при пересоздании стикерпака после перезапуска),
+    стикер загружается из файла в кэше.
+    Индекс хранится в базе (namespace sticker_assets) и переживает перезапуск и пересоздание стикерпака.
+    """
+
+    EXTENSIONS = {"static": "webp", "animated": "tgs", "video": "webm"}
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.index = {}  # file_unique_id → {"format", "file", "set_file_ids": {стикерпак: file_id}}
+        self.semaphore = asyncio.Semaphore(ASSET_DOWNLOAD_CONCURRENCY)
+        self.tasks = set()  # Фоновые задачи скачивания
+
+    def path(self, asset):
+        """Возвращает путь к файлу из кэша или None, если его нет на диске."""
+        if not asset.get("file"):
+            return None
+        path = os.path.join(self.directory, asset["file"])
+        return path if os.path.exists(path) else None
+
+    def _save(self, file_unique_id):
+        """Запоминает запись кэша для записи в базу."""
+        state_store.stage("sticker_assets", file_unique_id, self.index[file_unique_id])
+
+    async def ensure(self, sticker):
+        """Скачивает стикер, если его ещё нет в кэше."""
+        asset = self.index.get(sticker.file_unique_id, {})
+        if self.path(asset):
+            return
+        async with self.semaphore:
+            try:
+                file = await bot.get_file(sticker.file_id)
+                data = (await bot.download_file(file.file_path)).getvalue()
+            except Exception as e:
+                logger.error("Не удалось скачать стикер %s: %s", sticker.file_unique_id, e)
+                return
+        sticker_format_ = detect_sticker_format(data) or sticker_format(sticker)
+        if sticker_format_ != sticker_format(sticker):
+            logger.warning("Формат стикера %s по содержимому — %s, а не %s.", sticker.file_unique_id,
+                           sticker_format_, sticker_format(sticker))
+        name = f"{sticker.file_unique_id}.{self.EXTENSIONS[sticker_format_]}"
+        try:
+            await asyncio.to_thread(self._write_file, name, data)
+        except OSError as e:
+            logger.error("Не удалось сохранить стикер %s: %s", sticker.file_unique_id, e)
+            return
+        self.index[sticker.file_unique_id] = {**self.index.get(sticker.file_unique_id, {}),
+                                              "format": sticker_format_, "file": name}
+        self._save(sticker.file_unique_id)
+        logger.info("Стикер %s (%s) сохранён в кэш.", sticker.file_unique_id, sticker_format_)
+
+    def _write_file(self, name, data):
+        """Записывает файл в кэш атомарно."""
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    async def ensure_all(self, stickers):
+        """Скачивает недостающие стикеры параллельно."""
+        await asyncio.gather(*(self.ensure(sticker) for sticker in stickers))
+
+    def schedule(self, stickers):
+        """Запускает скачивание недостающих стикеров в фоне."""
+        task = asyncio.create_task(self.ensure_all(stickers))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def input_sticker(self, sticker, upload=False):
+        """Возвращает InputSticker для добавления стикера подарка в стикерпак. Запросов к Telegram не делает.
+
+        upload=True — загрузить файл из кэша вместо file_id, если он есть на диске.
+        """
+        asset = self.index.get(sticker.file_unique_id, {})
+        set_file_ids = asset.get("set_file_ids") or {}
+        path = self.path(asset)
+        if upload and path:
+            source = FSInputFile(path)
+        elif set_file_ids:
+            source = set_file_ids.get(STICKER_SET_NAME) or next(iter(set_file_ids.values()))
+        else:
+            source = sticker.file_id
+        return InputSticker(sticker=source, emoji_list=[sticker.emoji or "🎁"],
+                            format=asset.get("format") or sticker_format(sticker))
+
+    def cached(self, sticker):
+        """Проверяет, есть ли файл стикера в кэше."""
+        return self.path(self.index.get(sticker.file_unique_id, {})) is not None
+
+    def remember(self, file_unique_id, set_name, file_id):
+        """Запоминает file_id стикера в стикерпаке set_name."""
+        asset = self.index.setdefault(file_unique_id, {})
+        set_file_ids = asset.setdefault("set_file_ids", {})
+        if set_file_ids.get(set_name) != file_id:
+            set_file_ids[set_name] = file_id
+            self._save(file_unique_id)
+
+    def set_file_id(self, file_unique_id):
+        """Возвращает file_id стикера в текущем стикерпаке, если он там ещё есть."""
+        file_id = self.index.get(file_unique_id, {}).get("set_file_ids", {}).get(STICKER_SET_NAME)
+        return file_id if sticker_set_index.unique_id(file_id) is not None else None
+
+sticker_assets = StickerAssets(STICKER_ASSETS_DIR)
+
+# Проверяем существование стикерпака
+async def sticker_set_exists():
+    """Проверяет существование стикерпака. Запрос к Telegram делается только при первой проверке."""
+    if sticker_set_index.exists is None:
+        try:
+            await sticker_set_index.refresh()
+        except Exception as e:
+            logger.error("Ошибка при проверке существования стикерпака: %s", e)
+            return False
+    return sticker_set_index.exists
+
+# Получаем актуальный file_id стикера из стикерпака
+def get_sticker_file_id(file_unique_id):
+    """Получает file_id стикера из индекса стикерпака по file_unique_id."""
+    return sticker_set_index.get(file_unique_id)
+
+# Сохраняем file_id стикеров из стикерпака для добавленных подарков
+def map_gift_stickers(gifts, start):
+    """Сохраняет file_id стикеров для подарков, добавленных в стикерпак по порядку начиная с позиции start."""
+    for offset, gift in enumerate(gifts):
+        gift_id = str(gift.id)
+        file_id = get_sticker_file_id(gift.sticker.file_unique_id)
+        if file_id is None and start + offset < len(sticker_set_index):
+            # Telegram мог выдать стикеру в стикерпаке новый file_unique_id, тогда ищем его по позиции
+            file_id = sticker_set_index.file_ids[start + offset]
+        if file_id:
+            save_gift_sticker(gift_id, file_id)  # Сохраняем file_id по id подарка
+            sticker_assets.remember(gift.sticker.file_unique_id, STICKER_SET_NAME, file_id)
+            logger.info("Стикер для подарка %s сохранён с file_id: %s", gift_id, file_id)
+        else:
+            logger.error("Не удалось получить file_id для стикера подарка %s.", gift_id)
 
 # Создаём стикерпак, если его нет
 async def create_sticker_set_from_gifts(gifts):
-    """Создаёт стикерпак, если его нет."""
-    stickers = [InputSticker(sticker=gift.sticker.file_id, emoji_list=[gift.sticker.emoji], format="static") for gift in gifts]
+    """Создаёт стикерпак сразу из нескольких подарков (до 50 за запрос), остальные добавляет по одному."""
+    first_batch, rest = gifts[:MAX_STICKERS_PER_CREATE], gifts[MAX_STICKERS_PER_CREATE:]
     try:
-        await bot(CreateNewStickerSet(
-            user_id=USER_ID,
-            name=STICKER_SET_NAME,
-            title="Gift Stickers",
-            stickers=stickers,
-            sticker_type="regular"
-        ))
-        logger.info(f"Стикерпак '{STICKER_SET_NAME}' создан.")
+        try:
+            await bot(CreateNewStickerSet(
+                user_id=USER_ID,
+                name=STICKER_SET_NAME,
+                title="Gift Stickers",
+                stickers=[sticker_assets.input_sticker(gift.sticker) for gift in first_batch],
+                sticker_type="regular"
+            ))
+        except TelegramBadRequest as e:
+            if not any(sticker_assets.cached(gift.sticker) for gift in first_batch):
+                raise
+            # Telegram мог отклонить file_id: пробуем загрузить стикеры из кэша
+            logger.warning("Стикерпак не создан по file_id (%s), загружаем стикеры из кэша.", e)
+            await bot(CreateNewStickerSet(
+                user_id=USER_ID,
+                name=STICKER_SET_NAME,
+                title="Gift Stickers",
+                stickers=[sticker_assets.input_sticker(gift.sticker, upload=True) for gift in first_batch],
+                sticker_type="regular"
+            ))
+        logger.info("Стикерпак '%s' создан.", STICKER_SET_NAME)
 
-        # Получаем актуальные file_id стикеров из стикерпака
-        for gift in gifts:
-            file_id = await get_sticker_file_id(STICKER_SET_NAME, gift.sticker.emoji)
-            if file_id:
-                stickers_data[str(gift.id)] = file_id  # Сохраняем file_id по id подарка
-                logger.info(f"Стикер для подарка {gift.id} сохранён с file_id: {file_id}")
-            else:
-                logger.error(f"Не удалось получить file_id для стикера подарка {gift.id}.")
-
-        save_stickers_data()  # Сохраняем данные в файл
-        logger.info(f"Данные о стикерах сохранены в {STICKERS_FILE}.")
-    except TelegramAPIError as e:
-        if "Too Many Requests" in str(e):
-            retry_after = int(e.message.split("retry after ")[1])
-            logger.warning(f"Лимит запросов превышен. Ждём {retry_after} секунд...")
-            await asyncio.sleep(retry_after)
-            await create_sticker_set_from_gifts(gifts)  # Повторяем запрос после паузы
-        else:
-            logger.error(f"Ошибка создания стикерпака: {e}")
+        # Получаем актуальные file_id стикеров из стикерпака одним запросом
+        await sticker_set_index.refresh()
+        map_gift_stickers(first_batch, 0)
+    except Exception as e:
+        logger.error("Ошибка создания стикерпака: %s", e)
+        # Стикерпак мог быть создан, несмотря на ошибку (например, ответ не дошёл из-за таймаута),
+        # поэтому перечитываем его, а не считаем отсутствующим до перезапуска
+        sticker_set_index.exists = None
+        if await sticker_set_exists():
+            await add_stickers_to_set(gifts)
+        return
+
+    if rest:
+        await add_stickers_to_set(rest)
+
+# Добавляем стикер одного подарка в стикерпак
+async def add_sticker_to_set(gift):
+    """Добавляет стикер подарка в существующий стикерпак. Возвращает True, если стикер добавлен."""
+    gift_id = str(gift.id)
+    try:
+        sticker = sticker_assets.input_sticker(gift.sticker)
+        logger.info("Добавление стикера для подарка %s (%s) из %s", gift_id, sticker.format, sticker.sticker)
+        try:
+            await bot(AddStickerToSet(user_id=USER_ID, name=STICKER_SET_NAME, sticker=sticker))
+        except TelegramBadRequest as e:
+            if not sticker_assets.cached(gift.sticker):
+                raise
+            # Telegram мог отклонить file_id: загружаем стикер из кэша
+            logger.warning("Стикер для подарка %s не добавлен по file_id (%s), загружаем его из кэша.", gift_id, e)
+            await bot(AddStickerToSet(user_id=USER_ID, name=STICKER_SET_NAME,
+                                      sticker=sticker_assets.input_sticker(gift.sticker, upload=True)))
+        return True
     except Exception as e:
-        logger.error(f"Ошибка создания стикерпака: {e}")
+        logger.error("Ошибка добавления стикера для подарка %s: %s", gift_id, e)
+    return False
 
 # Добавляем новые стикеры в существующий стикерпак
 async def add_stickers_to_set(gifts):
-    """Добавляет новые стикеры в существующий стикерпак."""
+    """Добавляет новые стикеры в существующий стикерпак и один раз перечитывает его."""
+    added = []
+    start = len(sticker_set_index)
     for gift in gifts:
         gift_id = str(gift.id)  # Получаем ID подарка
-        logger.info(f"Обработка подарка с ID: {gift_id}")
+        if gift_id in stickers_data:
+            logger.info("Стикер для подарка %s уже существует в стикерпаке.", gift_id)
+            continue
 
-        if gift_id not in stickers_data:
-            try:
-                # Проверяем, существует ли уже стикер с таким file_id
-                existing_sticker = next((sticker for sticker in stickers_data.values() if sticker == gift.sticker.file_id), None)
-                if existing_sticker:
-                    logger.info(f"Стикер для подарка {gift_id} уже существует в стикерпаке.")
-                    continue
-
-                logger.info(f"Добавление стикера для подарка {gift_id} с file_id: {gift.sticker.file_id}")
-                sticker = InputSticker(sticker=gift.sticker.file_id, emoji_list=[gift.sticker.emoji], format="static")
-                await bot(AddStickerToSet(
-                    user_id=USER_ID,
-                    name=STICKER_SET_NAME,
-                    sticker=sticker
-                ))
-                # Получаем актуальный file_id стикера из стикерпака
-                file_id = await get_sticker_file_id(STICKER_SET_NAME, gift.sticker.emoji)
-                if file_id:
-                    stickers_data[gift_id] = file_id  # Сохраняем file_id по id подарка
-                    logger.info(f"Стикер для подарка {gift_id} добавлен с file_id: {file_id}.")
-                else:
-                    logger.error(f"Не удалось получить file_id для стикера подарка {gift_id}.")
-            except TelegramAPIError as e:
-                if "Too Many Requests" in str(e):
-                    retry_after = int(e.message.split("retry after ")[1])
-                    logger.warning(f"Лимит запросов превышен. Ждём {retry_after} секунд...")
-                    await asyncio.sleep(retry_after)
-                    await add_stickers_to_set([gift])  # Повторяем запрос после паузы
-                else:
-                    logger.error(f"Ошибка добавления стикера для подарка {gift_id}: {e}")
-            except Exception as e:
-                logger.error(f"Ошибка добавления стикера для подарка {gift_id}: {e}")
-        else:
-            logger.info(f"Стикер для подарка {gift_id} уже существует в стикерпаке.")
+        # Проверяем, есть ли уже такой стикер в стикерпаке
+        file_id = get_sticker_file_id(gift.sticker.file_unique_id) or sticker_assets.set_file_id(gift.sticker.file_unique_id)
+        if file_id:
+            save_gift_sticker(gift_id, file_id)
+            logger.info("Стикер для подарка %s уже существует в стикерпаке.", gift_id)
+            continue
+
+        if await add_sticker_to_set(gift):
+            added.append(gift)
+
+    if added:
+        # Получаем актуальные file_id всех добавленных стикеров одним запросом
+        try:
+            await sticker_set_index.refresh()
+        except Exception as e:
+            logger.error("Ошибка при получении стикерпака: %s", e)
+        map_gift_stickers(added, start)
 
-    save_stickers_data()  # Сохраняем данные в файл
-    logger.info(f"Данные о стикерах обновлены в {STICKERS_FILE}.")
+# Добавляем стикеры новых подарков в стикерпак
+async def ensure_gift_stickers(gifts):
+    """Добавляет стикеры подарков в стикерпак, создавая его при необходимости."""
+    missing = [gift for gift in gifts if str(gift.id) not in stickers_data]
+    if not missing:
+        return
+    if replay_mode:
+        # При воспроизведении журнала к Telegram не обращаемся
+        for gift in missing:
+            save_gift_sticker(str(gift.id), f"replay:{gift.id}")
+        return
+    if await sticker_set_exists():
+        await add_stickers_to_set(missing)
+    else:
+        await create_sticker_set_from_gifts(missing)
+    sticker_assets.schedule([gift.sticker for gift in missing])
+
+# Получаем file_id стикера для бота, который отправляет уведомления
+async def delivery_sticker_file_id(notification):
+    """Возвращает file_id стикера уведомления для delivery_bot.
+
+    Если уведомления отправляет другой бот, стикер ищется по file_unique_id в его копии стикерпака;
+    копия перечитывается, когда в ней ещё нет нужного стикера.
+    """
+    if delivery_bot is bot or not notification.sticker_unique_id:
+        return notification.sticker_file_id
+    file_id = delivery_sticker_index.get(notification.sticker_unique_id)
+    if file_id is None:
+        async with delivery_sticker_lock:
+            file_id = delivery_sticker_index.get(notification.sticker_unique_id)
+            if file_id is None:
+                await delivery_sticker_index.refresh()
+                file_id = delivery_sticker_index.get(notification.sticker_unique_id)
+    return file_id
 
 # Отправляем стикер и получаем его message_id
 async def send_sticker(chat_id, sticker_file_id):
     """Отправляет стикер и возвращает его message_id."""
     try:
-        message = await bot(SendSticker(
+        message = await delivery_bot(SendSticker(
             chat_id=chat_id,
             sticker=sticker_file_id
         ))
-        logger.info(f"Стикер {sticker_file_id} успешно отправлен.")
+        logger.info("Стикер %s успешно отправлен.", sticker_file_id)
         return message.message_id  # Возвращаем message_id стикера
-    except TelegramAPIError as e:
-        if "Too Many Requests" in str(e):
-            retry_after = int(e.message.split("retry after ")[1])
-            logger.warning(f"Лимит запросов превышен. Ждём {retry_after} секунд...")
-            await asyncio.sleep(retry_after)
-            return await send_sticker(chat_id, sticker_file_id)  # Повторяем запрос после паузы
-        else:
-            logger.error(f"Ошибка при отправке стикера {sticker_file_id}: {e}")
-            return None
     except Exception as e:
-        logger.error(f"Ошибка при отправке стикера {sticker_file_id}: {e}")
+        logger.error("Ошибка при отправке стикера %s: %s", sticker_file_id, e)
         return None
 
 # Отправляем текст как reply к стикеру
 async def send_text_as_reply(chat_id, text, reply_to_message_id):
-    """Отправляет текстовое сообщение как reply к указанному message_id."""
+    """Отправляет текстовое сообщение как reply к указанному message_id и возвращает его message_id."""
     try:
-        await bot.send_message(
+        message = await delivery_bot.send_message(
             chat_id=chat_id,
             text=text,
             reply_to_message_id=reply_to_message_id,
             parse_mode="HTML"
         )
-        logger.info(f"Текстовое сообщение отправлено как reply к сообщению с ID {reply_to_message_id}.")
-    except TelegramAPIError as e:
-        if "Too Many Requests" in str(e):
-            retry_after = int(e.message.split("retry after ")[1])
-            logger.warning(f"Лимит запросов превышен. Ждём {retry_after} секунд...")
-            await asyncio.sleep(retry_after)
-            await send_text_as_reply(chat_id, text, reply_to_message_id)  # Повторяем запрос после паузы
-        else:
-            logger.error(f"Ошибка при отправке текстового сообщения: {e}")
+        logger.info("Текстовое сообщение отправлено как reply к сообщению с ID %s.", reply_to_message_id)
+        return message.message_id
     except Exception as e:
-        logger.error(f"Ошибка при отправке текстового сообщения: {e}")
+        logger.error("Ошибка при отправке текстового сообщения: %s", e)
+        return None
 
-# Проверяем, достиг ли подарок порога в 11% или полностью раскуплен
-async def check_gift_threshold(gift):
-    """Проверяет, достиг ли подарок порога в 11% или полностью раскуплен."""
-    gift_id = str(gift.id)
-    total_count = gift.total_count
-    remaining_count = gift.remaining_count
+# Ограничитель частоты запросов
+class TokenBucket:
+    """Ограничитель частоты по алгоритму token bucket: rate токенов в секунду, не больше capacity подряд."""
 
-    # Игнорируем подарки с бесконечным количеством
-    if total_count is None or total_count == 0:
-        return
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
 
-    # Проверяем, достиг ли подарок порога в 11%
-    threshold = total_count * 0.11  # Порог в 11%
-    if remaining_count <= threshold and gift_id not in notified_gifts["threshold"]:
-        # Уведомляем о достижении порога
-        notification_text = (
-            f"⚠️ <b>Gift low supply ALERT!</b>\n"
-            f"<b>ID:</b> <code>{gift_id}</code>\n"
-            f"<b>Осталось:</b> <code>{remaining_count}/{total_count}</code>"
-        )
-        # Отправляем уведомление в канал
-        sticker_file_id = stickers_data.get(gift_id)
-        if sticker_file_id:
-            sticker_message_id = await send_sticker(CHANNEL_ID, sticker_file_id)
-            if sticker_message_id:
-                await send_text_as_reply(CHANNEL_ID, notification_text, sticker_message_id)
-        else:
-            logger.error(f"Стикер для подарка {gift_id} не найден в stickers.json.")
-
-        # Сохраняем информацию об уведомлении
-        notified_gifts["threshold"][gift_id] = True
-        save_notified_gifts()
-        logger.info(f"Уведомление о пороге 11% для подарка {gift_id} сохранено.")
-
-    # Проверяем, раскуплен ли подарок
-    if remaining_count == 0 and gift_id not in notified_gifts["sold_out"]:
-        # Уведомляем о том, что подарок раскуплен
-        notification_text = (
-            f"🛑 <b>Gift SOLD!</b>\n"
-            f"<b>ID:</b> <code>{gift_id}</code>"
+    async def acquire(self):
+        """Ждёт, пока освободится токен, и забирает его."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+# Уведомление: стикер и текст, который уходит reply к этому стикеру
+@dataclass
+class Notification:
+    chat_id: int | str
+    sticker_file_id: str | None  # None — дайджест, "" — стикер подарка не загружен: только текст, без стикера
+    text: str
+    detected_at: float | None = None  # Когда было получено изменение, о котором уведомление
+    outbox_ids: tuple = ()  # Записи outbox, которые нужно отметить после отправки
+    sticker_message_id: int | None = None  # Стикер уже отправлен раньше, осталось отправить reply
+    sticker_unique_id: str | None = None  # file_unique_id стикера, чтобы найти его file_id у другого бота
+
+# Очередь уведомлений с пулом воркеров
+class NotificationDispatcher:
+    """Рассылает уведомления параллельно, соблюдая общий лимит Telegram и лимит на каждый чат.
+
+    Каждое уведомление целиком обрабатывается одним воркером, поэтому reply всегда уходит после своего стикера.
+    """
+
+    def __init__(self, workers=NOTIFICATION_WORKERS, queue_size=NOTIFICATION_QUEUE_SIZE,
+                 global_rate=GLOBAL_RATE_LIMIT, chat_delay=DELAY_BETWEEN_MESSAGES, chat_burst=CHAT_BURST):
+        self.workers = workers
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.global_limiter = TokenBucket(global_rate, global_rate)
+        self.chat_delay = chat_delay
+        self.chat_burst = chat_burst
+        self.chat_limiters = {}
+        self.tasks = []
+
+    def start(self):
+        """Запускает воркеры отправки."""
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def submit(self, notification):
+        """Ставит уведомление в очередь. Если очередь заполнена, ждёт свободного места."""
+        await self.queue.put(notification)
+
+    async def stop(self, timeout=30):
+        """Дожидается отправки очереди (не дольше timeout секунд) и останавливает воркеры."""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Не удалось отправить %s уведомлений до остановки.", self.queue.qsize())
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    def _chat_limiter(self, chat_id):
+        """Возвращает ограничитель частоты для чата."""
+        limiter = self.chat_limiters.get(chat_id)
+        if limiter is None:
+            rate = 1 / self.chat_delay if self.chat_delay > 0 else GLOBAL_RATE_LIMIT
+            limiter = self.chat_limiters[chat_id] = TokenBucket(rate, self.chat_burst)
+        return limiter
+
+    async def _throttle(self, chat_id):
+        """Ждёт разрешения на отправку одного сообщения в чат."""
+        await self._chat_limiter(chat_id).acquire()
+        await self.global_limiter.acquire()
+
+    async def _deliver(self, notification):
+        """Отправляет стикер и текст reply к нему. Возвращает True, если отправлено и то и другое."""
+        if not notification.sticker_file_id:
+            await self._throttle(notification.chat_id)
+            return bool(await send_text_as_reply(notification.chat_id, notification.text, None))
+        sticker_message_id = notification.sticker_message_id
+        if not sticker_message_id:
+            sticker_file_id = await delivery_sticker_file_id(notification)
+            await self._throttle(notification.chat_id)
+            sticker_message_id = await send_sticker(notification.chat_id, sticker_file_id)
+            if not sticker_message_id:
+                logger.error("Не удалось отправить стикер %s.", notification.sticker_file_id)
+                return False
+            if notification.outbox_ids:
+                await outbox.sticker_sent(notification, sticker_message_id)
+        await self._throttle(notification.chat_id)
+        return bool(await send_text_as_reply(notification.chat_id, notification.text, sticker_message_id))
+
+    async def _worker(self):
+        """Забирает уведомления из очереди и отправляет их."""
+        while True:
+            notification = await self.queue.get()
+            started = time.perf_counter()
+            sent = False
+            try:
+                sent = await self._deliver(notification)
+            except Exception as e:
+                logger.error("Ошибка при отправке уведомления: %s", e)
+            finally:
+                stage_seconds.observe(time.perf_counter() - started, stage="deliver")
+                notifications_total.inc(result="sent" if sent else "failed")
+                if sent and notification.detected_at is not None:
+                    detection_latency_seconds.observe(time.time() - notification.detected_at)
+                if notification.outbox_ids:
+                    await outbox.finish(notification, sent)
+                self.queue.task_done()
+
+dispatcher = NotificationDispatcher()
+METRICS.append(Gauge("gifts_notification_queue_depth", "Уведомления в очереди на отправку", lambda: dispatcher.queue.qsize()))
+
+# Надёжная очередь уведомлений
+class Outbox:
+    """Хранит уведомления в базе, пока Telegram не подтвердит их отправку.
+
+    Обнаружение изменений только добавляет записи (с ключом идемпотентности), и они
+    записываются той же транзакцией, что и отметки об уведомлениях. Отдельный цикл
+    забирает неотправленные записи и передаёт их в NotificationDispatcher; запись
+    отмечается отправленной только после ответа Telegram. После перезапуска
+    неотправленные записи отправляются заново, а уже отправленный стикер не дублируется.
+
+    Если у чата в очереди DIGEST_MIN_EVENTS событий и больше, они уходят дайджестами:
+    вместо стикера и reply на каждое событие — одно текстовое сообщение на несколько событий.
+    Так время доставки при массовом релизе растёт с общим объёмом текста, а не с числом событий.
+    """
+
+    def __init__(self, store, node=CLUSTER_NODE, size=CLUSTER_SIZE):
+        self.store = store
+        self.node = node  # Этот процесс отправляет только чаты с chat_hash % size == node
+        self.size = size
+        self.in_flight = {}  # id записи, переданной в dispatcher → chat_id
+        self.wakeup = asyncio.Event()
+
+    def add(self, key, chat_id, sticker_file_id, text, sticker_unique_id=None):
+        """Добавляет уведомление. Оно попадёт в базу при следующем commit() состояния."""
+        self.store.stage_outbox(key, chat_id, sticker_file_id, text, detected_at.get(), sticker_unique_id)
+
+    def wake(self):
+        """Будит цикл отправки после записи новых уведомлений."""
+        self.wakeup.set()
+
+    async def run(self):
+        """Передаёт неотправленные записи в dispatcher."""
+        await self.store.run(self.store.purge_outbox, time.time() - OUTBOX_RETENTION)
+        while True:
+            try:
+                rows = await self.store.run(self.store.load_outbox, time.time(), OUTBOX_BATCH + len(self.in_flight),
+                                            self.node, self.size)
+            except sqlite3.Error as e:
+                logger.error("Ошибка при чтении outbox: %s", e)
+                rows = []
+            rows = [row for row in rows if row[0] not in self.in_flight]
+            for notification in self.coalesce(rows):
+                for outbox_id in notification.outbox_ids:
+                    self.in_flight[outbox_id] = notification.chat_id
+                await dispatcher.submit(notification)
+            if len(rows) >= OUTBOX_BATCH:
+                continue  # Забрали полную пачку: скорее всего, есть ещё
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), OUTBOX_POLL_INTERVAL)
+                if DIGEST_WINDOW:
+                    await asyncio.sleep(DIGEST_WINDOW)  # Даём накопиться событиям для дайджеста
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+
+    def coalesce(self, rows):
+        """Собирает уведомления из записей outbox, объединяя события чатов с большой очередью в дайджесты."""
+        backlog = {}  # chat_id → событий в очереди, включая уже переданные в dispatcher
+        for chat_id in self.in_flight.values():
+            backlog[chat_id] = backlog.get(chat_id, 0) + 1
+        by_chat = {}
+        for row in rows:
+            by_chat.setdefault(row[1], []).append(row)
+
+        notifications = []
+        for chat_id, chat_rows in by_chat.items():
+            digest = DIGEST_MIN_EVENTS and len(chat_rows) + backlog.get(chat_id, 0) >= DIGEST_MIN_EVENTS
+            parts = []
+            for outbox_id, _, sticker_file_id, text, detected, attempts, sticker_message_id, unique_id in chat_rows:
+                if digest and not sticker_message_id:
+                    parts.append((outbox_id, text, detected))
+                else:
+                    notifications.append(Notification(chat_id, sticker_file_id, text, detected,
+                                                      (outbox_id,), sticker_message_id, unique_id))
+            notifications.extend(self.digests(chat_id, parts))
+        notifications.sort(key=lambda notification: notification.outbox_ids[0])
+        return notifications
+
+    @staticmethod
+    def digests(chat_id, parts):
+        """Разбивает события чата на дайджесты не длиннее MAX_MESSAGE_LENGTH символов."""
+        chunks = []
+        chunk = []
+        length = 32  # Запас на заголовок
+        for part in parts:
+            size = len(part[1]) + 2
+            if chunk and length + size > MAX_MESSAGE_LENGTH:
+                chunks.append(chunk)
+                chunk = []
+                length = 32
+            chunk.append(part)
+            length += size
+        if chunk:
+            chunks.append(chunk)
+
+        notifications = []
+        for chunk in chunks:
+            text = f"📰 <b>GIFTS DIGEST</b> ({len(chunk)})\n\n" + "\n\n".join(text for _, text, _ in chunk)
+            detected = [detected for _, _, detected in chunk if detected is not None]
+            notifications.append(Notification(chat_id, None, text, min(detected, default=None),
+                                              tuple(outbox_id for outbox_id, _, _ in chunk)))
+            notifications_coalesced_total.inc(len(chunk))
+        return notifications
+
+    async def sticker_sent(self, notification, sticker_message_id):
+        """Запоминает отправленный стикер, чтобы при повторе отправить только reply."""
+        notification.sticker_message_id = sticker_message_id
+        try:
+            await self.store.run(self.store.update_outbox, notification.outbox_ids, sticker_message_id=sticker_message_id)
+        except sqlite3.Error as e:
+            logger.error("Ошибка при сохранении outbox: %s", e)
+
+    async def finish(self, notification, sent):
+        """Отмечает записи отправленными или планирует повтор."""
+        now = time.time()
+        try:
+            if sent:
+                await self.store.run(self.store.update_outbox, notification.outbox_ids,
+                                     status="delivered", delivered_at=now)
+            else:
+                attempts = await self.store.run(self._record_failure, notification.outbox_ids, now)
+                if attempts >= OUTBOX_MAX_ATTEMPTS:
+                    logger.error("Уведомление %s не отправлено после %s попыток.", notification.outbox_ids, attempts)
+        except sqlite3.Error as e:
+            logger.error("Ошибка при сохранении outbox: %s", e)
+        finally:
+            for outbox_id in notification.outbox_ids:
+                self.in_flight.pop(outbox_id, None)
+
+    def _record_failure(self, outbox_ids, now):
+        """Увеличивает счётчики попыток и откладывает следующую. Возвращает наибольшее число попыток."""
+        most_attempts = 0
+        for outbox_id in outbox_ids:
+            (attempts,) = self.store.conn.execute("SELECT attempts FROM outbox WHERE id = ?", (outbox_id,)).fetchone()
+            attempts += 1
+            self.store.update_outbox(
+                (outbox_id,),
+                attempts=attempts,
+                next_attempt_at=now + min(OUTBOX_MAX_RETRY_DELAY, OUTBOX_RETRY_DELAY * 2 ** (attempts - 1)),
+                status="failed" if attempts >= OUTBOX_MAX_ATTEMPTS else "pending"
+            )
+            most_attempts = max(most_attempts, attempts)
+        return most_attempts
+
+outbox = Outbox(state_store)
+
+# Типы событий, на которые можно подписаться
+EVENT_TYPES = ("new", "threshold", "rate", "sold_out", "upgrade", "removed")
+
+# Подписка чата на уведомления
+@dataclass
+class Subscription:
+    chat_id: str
+    min_stars: int = 0  # Минимальная цена подарка в звёздах
+    max_stars: int | None = None  # Максимальная цена (None — без ограничения)
+    limited_only: bool = False  # Только подарки с ограниченным тиражом
+    levels: frozenset | None = None  # Уровни остатка для уведомлений о пороге (None — все)
+    events: frozenset | None = None  # Типы событий из EVENT_TYPES (None — все)
+
+    @classmethod
+    def from_state(cls, chat_id, state):
+        """Создаёт подписку из сохранённых фильтров."""
+        levels = state.get("levels")
+        events = state.get("events")
+        return cls(
+            str(chat_id),
+            int(state.get("min_stars") or 0),
+            state.get("max_stars"),
+            bool(state.get("limited_only")),
+            frozenset(float(level) for level in levels) if levels is not None else None,
+            frozenset(events) if events is not None else None
         )
-        # Отправляем уведомление в канал
-        sticker_file_id = stickers_data.get(gift_id)
-        if sticker_file_id:
-            sticker_message_id = await send_sticker(CHANNEL_ID, sticker_file_id)
-            if sticker_message_id:
-                await send_text_as_reply(CHANNEL_ID, notification_text, sticker_message_id)
-        else:
-            logger.error(f"Стикер для подарка {gift_id} не найден в stickers.json.")
 
-        # Сохраняем информацию об уведомлении
-        notified_gifts["sold_out"][gift_id] = True
-        save_notified_gifts()
-        logger.info(f"Уведомление о раскупленности для подарка {gift_id} сохранено.")
+    def to_state(self):
+        """Возвращает фильтры подписки для сохранения в базе."""
+        return {
+            "min_stars": self.min_stars,
+            "max_stars": self.max_stars,
+            "limited_only": self.limited_only,
+            "levels": sorted(self.levels) if self.levels is not None else None,
+            "events": sorted(self.events) if self.events is not None else None
+        }
 
-# Проверяем новые апгрейды
-async def check_for_upgrades(current_gifts):
-    """Проверяет, есть ли новые апгрейды подарков."""
-    gifts_state = load_gifts_state()  # Загружаем текущее состояние
-    new_upgrades = []
+    def accepts(self, star_count, limited, levels):
+        """Проверяет фильтры, кроме типа события и нижней границы цены (их проверяет индекс).
 
-    for gift in current_gifts.gifts:
-        gift_id = str(gift.id)
-        if gift_id not in gifts_state:
-            # Новый подарок, добавляем в состояние
-            gifts_state[gift_id] = {
-                "upgrades": gift.upgrades if hasattr(gift, 'upgrades') else [],
-                "remaining_count": gift.remaining_count,
-                "total_count": gift.total_count
-            }
+        levels — уровни остатка, пройденные с прошлого снимка: подписке достаточно любого из своих.
+        """
+        if self.max_stars is not None and star_count > self.max_stars:
+            return False
+        if self.limited_only and not limited:
+            return False
+        return levels is None or self.levels is None or not self.levels.isdisjoint(levels)
+
+# Подписчики и индекс по их фильтрам
+class SubscriberRegistry:
+    """Хранит подписки и подбирает получателей события без перебора всех подписчиков.
+
+    Подписки разложены по типам событий и отсортированы по min_stars, поэтому для события
+    просматриваются только подписчики этого типа с подходящей нижней границей цены. Результат
+    подбора кэшируется по (тип, цена, лимитированность, уровни): у подарков одного релиза всего
+    несколько разных цен, и на тысячи подписчиков приходится лишь несколько подборов.
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.subscriptions = {}  # chat_id → Subscription
+        self.index = {}  # тип события → (min_stars по возрастанию, подписки в том же порядке)
+        self.cache = {}  # (тип, цена, лимитированность, уровни) → список chat_id
+
+    def load(self):
+        """Загружает подписки из базы и файла SUBSCRIBERS_FILE."""
+        self.subscriptions = {chat_id: Subscription.from_state(chat_id, state)
+                              for chat_id, state in self.store.load("subscribers").items()}
+        self.import_file(SUBSCRIBERS_FILE)
+        if CHANNEL_ID and CHANNEL_ID not in self.subscriptions:
+            self.subscriptions[CHANNEL_ID] = Subscription(CHANNEL_ID)
+        self.rebuild()
+
+    def import_file(self, path):
+        """Добавляет или обновляет подписки из JSON-файла: списка объектов с chat_id и фильтрами."""
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, "r") as f:
+                entries = json.load(f)
+            subscriptions = [Subscription.from_state(entry["chat_id"], entry) for entry in entries]
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            logger.error("Не удалось прочитать подписки из %s: %s", path, e)
+            return
+        for subscription in subscriptions:
+            self.subscriptions[subscription.chat_id] = subscription
+            self.store.stage("subscribers", subscription.chat_id, subscription.to_state())
+        logger.info("Подписок загружено из %s: %s", path, len(subscriptions))
+
+    def subscribe(self, subscription):
+        """Добавляет или заменяет подписку чата."""
+        self.subscriptions[subscription.chat_id] = subscription
+        self.store.stage("subscribers", subscription.chat_id, subscription.to_state())
+        self.rebuild()
+
+    def unsubscribe(self, chat_id):
+        """Удаляет подписку чата."""
+        chat_id = str(chat_id)
+        if self.subscriptions.pop(chat_id, None) is not None:
+            self.store.stage("subscribers", chat_id, None)
+            self.rebuild()
+
+    def rebuild(self):
+        """Перестраивает индекс после изменения подписок."""
+        self.index = {}
+        for event in EVENT_TYPES:
+            matching = sorted((subscription for subscription in self.subscriptions.values()
+                               if subscription.events is None or event in subscription.events),
+                              key=lambda subscription: subscription.min_stars)
+            self.index[event] = ([subscription.min_stars for subscription in matching], matching)
+        self.cache.clear()
+
+    def match(self, event, star_count, limited, levels=None):
+        """Возвращает chat_id подписчиков, которым нужно событие. levels — кортеж пройденных уровней остатка."""
+        key = (event, star_count, limited, levels)
+        chat_ids = self.cache.get(key)
+        if chat_ids is None:
+            bounds, matching = self.index.get(event, ((), ()))
+            candidates = matching[:bisect.bisect_right(bounds, star_count)]
+            chat_ids = self.cache[key] = [subscription.chat_id for subscription in candidates
+                                          if subscription.accepts(star_count, limited, levels)]
+        return chat_ids
+
+    def __len__(self):
+        return len(self.subscriptions)
+
+subscribers = SubscriberRegistry(state_store)
+
+pending_notifications = []  # Уведомления цикла, ещё не поставленные в outbox
+
+# Рассылаем событие о подарке подписчикам
+def publish(event, record, text, key, levels=None, details=None, notify=True):
+    """Сразу отдаёт событие в локальный поток, а уведомление подписчикам откладывает до queue_notifications().
+
+    Текст готовится один раз на событие. key — ключ идемпотентности события: для каждого чата
+    он дополняется @chat_id, и повторное уведомление с тем же ключом не создаётся. levels —
+    пройденные уровни остатка от верхнего к самому низкому. details — дополнительные поля
+    события для локального потока. notify=False — событие только для локального потока.
+    """
+    event_stream.publish(event, {"gift": record._asdict(), "level": levels[-1] if levels else None,
+                                 "levels": list(levels or ()), **(details or {})})
+    if notify:
+        pending_notifications.append((event, record, text, key, levels))
+
+# Ставим отложенные уведомления в outbox
+def queue_notifications():
+    """Добавляет в outbox стикер подарка и текст reply к нему для каждого подходящего подписчика.
+
+    Стикер отправляется по file_id из стикерпака и не загружается заново. Если стикера подарка
+    в стикерпаке нет, уведомление всё равно ставится в outbox и отправляется одним текстом:
+    вызывающий код уже отметил событие как обработанное.
+    """
+    for event, record, text, key, levels in pending_notifications:
+        sticker_file_id = stickers_data.get(record.id) or ""
+        if not sticker_file_id:
+            logger.warning("Стикер для подарка %s не найден, уведомление будет отправлено без него.", record.id)
+        sticker_unique_id = sticker_set_index.unique_id(sticker_file_id) if sticker_file_id else None
+        for chat_id in subscribers.match(event, record.star_count or 0, record.is_limited(), levels):
+            outbox.add(f"{key}@{chat_id}", chat_id, sticker_file_id, text, sticker_unique_id)
+    pending_notifications.clear()
+
+# Компактная запись о подарке в снимке
+class GiftRecord(NamedTuple):
+    id: str
+    star_count: int
+    total_count: int | None
+    remaining_count: int | None
+    upgrades: tuple
+
+    @classmethod
+    def from_gift(cls, gift):
+        """Создаёт запись из подарка, полученного от Telegram."""
+        upgrades = tuple(str(upgrade) for upgrade in getattr(gift, "upgrades", None) or ())
+        return cls(str(gift.id), gift.star_count, gift.total_count, gift.remaining_count, upgrades)
+
+    @classmethod
+    def from_state(cls, gift_id, state):
+        """Создаёт запись из сохранённого состояния подарка."""
+        return cls(gift_id, state.get("star_count", 0), state.get("total_count"),
+                   state.get("remaining_count"), tuple(str(upgrade) for upgrade in state.get("upgrades", ())))
+
+    def to_state(self):
+        """Возвращает состояние подарка для сохранения в базе."""
+        return {
+            "star_count": self.star_count,
+            "upgrades": list(self.upgrades),
+            "remaining_count": self.remaining_count,
+            "total_count": self.total_count
+        }
+
+    def is_limited(self):
+        """Проверяет, ограничен ли тираж подарка."""
+        return bool(self.total_count) and self.remaining_count is not None
+
+# Изменения между двумя снимками GetAvailableGifts
+@dataclass
+class Changeset:
+    added: list = field(default_factory=list)  # Новые подарки (Gift)
+    removed: list = field(default_factory=list)  # Снятые с продажи подарки (GiftRecord из прошлого снимка)
+    forgotten: list = field(default_factory=list)  # Подарки из сохранённого состояния, которых нет в первом снимке
+    changed: list = field(default_factory=list)  # Записи, отличающиеся от прошлого снимка (GiftRecord)
+    remaining_deltas: dict = field(default_factory=dict)  # gift_id → изменение остатка
+    threshold_crossed: list = field(default_factory=list)  # (GiftRecord, пройденные уровни в %), остаток опустился до уровней
+    sold_out: list = field(default_factory=list)  # Раскупленные подарки (GiftRecord)
+    upgrades: list = field(default_factory=list)  # (gift_id, новые апгрейды)
+
+    def __bool__(self):
+        return bool(self.added or self.removed or self.changed or self.forgotten)
+
+# Движок сравнения снимков
+class SnapshotDiffer:
+    """Держит прошлый снимок подарков в памяти и за один проход строит Changeset для нового."""
+
+    def __init__(self):
+        self.previous = {}  # gift_id → GiftRecord
+        self.sources = {}  # gift_id → Gift, из которого собрана запись прошлого снимка
+        self.seeded = set()  # gift_id из сохранённого состояния, ещё не сверенные с живым снимком
+
+    def seed(self, state):
+        """Восстанавливает прошлый снимок из сохранённого состояния подарков.
+
+        Состояние могло накопить подарки, давно снятые с продажи (старый gifts_state.json не удалял их),
+        поэтому пропавшие из первого живого снимка подарки попадают в forgotten, а не в removed.
+        """
+        self.previous = {gift_id: GiftRecord.from_state(gift_id, data) for gift_id, data in state.items()}
+        self.sources = {}
+        self.seeded = set(self.previous)
+
+    def diff(self, gifts):
+        """Сравнивает новый список подарков с прошлым снимком и запоминает новый снимок."""
+        changeset = Changeset()
+        previous = self.previous
+        sources = self.sources
+        current = {}
+        current_sources = {}
+        for gift in gifts:
+            gift_id = str(gift.id)
+            current_sources[gift_id] = gift
+            # GiftsFetcher переиспользует объект Gift, если запись подарка не изменилась
+            if sources.get(gift_id) is gift and gift_id in previous:
+                current[gift_id] = previous[gift_id]
+                continue
+            record = GiftRecord.from_gift(gift)
+            current[record.id] = record
+            before = previous.get(record.id)
+            if before is None:
+                changeset.added.append(gift)
+            elif before == record:
+                continue
+            changeset.changed.append(record)
+
+            if before is not None and record.upgrades != before.upgrades:
+                known = set(before.upgrades)
+                new_upgrades = [upgrade for upgrade in record.upgrades if upgrade not in known]
+                if new_upgrades:
+                    changeset.upgrades.append((record.id, new_upgrades))
+
+            remaining = record.remaining_count
+            if not record.is_limited():
+                continue
+            before_remaining = before.remaining_count if before else None
+            if before_remaining is not None and before_remaining != remaining:
+                changeset.remaining_deltas[record.id] = remaining - before_remaining
+            levels = crossed_levels(record.total_count, remaining, before_remaining)
+            if levels:
+                changeset.threshold_crossed.append((record, levels))
+            if remaining == 0 and before_remaining != 0:
+                changeset.sold_out.append(record)
+
+        if len(current) != len(previous) or changeset.added:
+            for gift_id, record in previous.items():
+                if gift_id not in current:
+                    (changeset.forgotten if gift_id in self.seeded else changeset.removed).append(record)
+        self.seeded = set()  # После первого снимка все оставшиеся подарки сверены с ним
+        self.previous = current
+        self.sources = current_sources
+        return changeset
+
+differ = SnapshotDiffer()
+
+# Находим уровни остатка, пройденные с прошлого снимка
+def crossed_levels(total_count, remaining_count, previous_count=None):
+    """Возвращает уровни из ALERT_LEVELS, до которых опустился остаток с прошлого снимка,
+    от верхнего к самому низкому, или пустой кортеж, если ни один уровень не пройден."""
+    crossed = []
+    for level in ALERT_LEVELS:
+        threshold = total_count * level / 100
+        if remaining_count > threshold:
+            break
+        if previous_count is None or previous_count > threshold:
+            crossed.append(level)
+    return tuple(crossed)
+
+# История остатков подарков
+class SupplyHistory:
+    """Кольцевые буферы остатков для всех лимитированных подарков в общих массивах.
+
+    Подарку выделяется слот из SUPPLY_HISTORY_SIZE значений; время и остаток хранятся
+    в array.array подряд по слотам, без словарей с float на каждое значение.
+    """
+
+    def __init__(self, capacity=SUPPLY_HISTORY_SIZE):
+        self.capacity = capacity
+        self.slots = {}  # gift_id → номер слота
+        self.free_slots = []
+        self.times = array("d")
+        self.counts = array("q")
+        self.lengths = array("l")  # Сколько значений записано в слот
+        self.heads = array("l")  # Позиция следующей записи в слоте
+
+    def _slot(self, gift_id):
+        """Возвращает слот подарка, выделяя новый при необходимости."""
+        slot = self.slots.get(gift_id)
+        if slot is None:
+            if self.free_slots:
+                slot = self.free_slots.pop()
+                self.lengths[slot] = 0
+                self.heads[slot] = 0
+            else:
+                slot = len(self.lengths)
+                self.times.extend([0.0] * self.capacity)
+                self.counts.extend([0] * self.capacity)
+                self.lengths.append(0)
+                self.heads.append(0)
+            self.slots[gift_id] = slot
+        return slot
+
+    def record(self, gift_id, now, remaining_count):
+        """Добавляет значение остатка подарка."""
+        slot = self._slot(gift_id)
+        head = self.heads[slot]
+        index = slot * self.capacity + head
+        self.times[index] = now
+        self.counts[index] = remaining_count
+        self.heads[slot] = (head + 1) % self.capacity
+        self.lengths[slot] = min(self.lengths[slot] + 1, self.capacity)
+
+    def drop(self, gift_id):
+        """Освобождает слот подарка."""
+        slot = self.slots.pop(gift_id, None)
+        if slot is not None:
+            self.free_slots.append(slot)
+
+    def estimate(self, now, window=SUPPLY_RATE_WINDOW):
+        """Считает для всех подарков сразу скорость продаж (штук в минуту) и прогноз распродажи.
+
+        Остаток между записями не меняется (записи делаются при каждом изменении), поэтому продажи
+        за окно — это разница между последним значением до начала окна и текущим.
+        Возвращает gift_id → (скорость в минуту, секунд до распродажи или None).
+        """
+        capacity = self.capacity
+        times, counts, lengths, heads = self.times, self.counts, self.lengths, self.heads
+        start = now - window
+        estimates = {}
+        for gift_id, slot in self.slots.items():
+            length = lengths[slot]
+            if not length:
+                continue
+            base = slot * capacity
+            head = heads[slot]
+            last = base + (head - 1) % capacity
+            reference = last
+            for back in range(2, length + 1):
+                if times[reference] <= start:
+                    break
+                reference = base + (head - back) % capacity
+            elapsed = window if times[reference] <= start else now - times[reference]
+            sold = counts[reference] - counts[last]
+            rate = sold * 60 / elapsed if elapsed > 0 else 0.0
+            eta = counts[last] * 60 / rate if rate > 0 else None
+            estimates[gift_id] = (rate, eta)
+        return estimates
+
+supply_history = SupplyHistory()
+rate_alerts = {}  # gift_id → время последнего уведомления о скорости продаж
+
+# Форматируем прогноз распродажи
+def format_eta(eta):
+    """Возвращает прогноз распродажи в читаемом виде."""
+    if eta is None:
+        return "—"
+    if eta < 60:
+        return f"~{int(eta)} сек"
+    if eta < 3600:
+        return f"~{int(eta // 60)} мин"
+    return f"~{int(eta // 3600)} ч {int(eta % 3600 // 60)} мин"
+
+# Журнал снимков GetAvailableGifts
+class SnapshotLog:
+    """Дописывает изменившиеся ответы GetAvailableGifts в файл и читает их обратно.
+
+    Файл начинается с MAGIC, дальше идут записи: заголовок (тип, время, длина) и сжатый zlib
+    JSON. Запись-снимок (keyframe) содержит все подарки, запись-дельта — только изменившиеся
+    и добавленные записи, id пропавших и порядок id, если он изменился. Снимок пишется первым
+    после открытия файла и затем раз в SNAPSHOT_KEYFRAME_INTERVAL записей, поэтому журнал можно
+    читать с любого снимка. Чтение идёт через mmap: в памяти держится только текущее состояние,
+    а не весь журнал.
+    """
+
+    MAGIC = b"GIFTLOG1"
+    HEADER = struct.Struct("<BdI")  # тип записи, время снимка, длина сжатых данных
+    KEYFRAME, DELTA = 0, 1
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.last = None  # gift_id → запись подарка из последнего записанного снимка
+        self.since_keyframe = 0
+        self.disabled = not path  # Запись выключена настройкой или после ошибки
+
+    def open(self):
+        """Открывает файл на дозапись, отрезав недописанную последнюю запись.
+
+        Записи с повреждёнными данными в середине файла не трогаются: их пропускает чтение.
+        """
+        if not os.path.exists(self.path) or os.path.getsize(self.path) < len(self.MAGIC):
+            with open(self.path, "wb") as f:
+                f.write(self.MAGIC)
+        end = len(self.MAGIC)
+        for end, _, _ in self.records(self.path):
+            pass
+        self.file = open(self.path, "r+b")
+        self.file.truncate(end)
+        self.file.seek(0, os.SEEK_END)
+
+    def close(self):
+        """Закрывает файл."""
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    async def append(self, timestamp, entries):
+        """Дописывает снимок (gift_id → запись подарка) дельтой к предыдущему."""
+        if self.last is None or self.since_keyframe >= SNAPSHOT_KEYFRAME_INTERVAL:
+            kind, payload = self.KEYFRAME, {"gifts": list(entries.values())}
+            self.since_keyframe = 0
         else:
-            # Проверяем, есть ли новые апгрейды
-            current_upgrades = gift.upgrades if hasattr(gift, 'upgrades') else []
-            previous_upgrades = gifts_state[gift_id].get("upgrades", [])
+            kind, payload = self.DELTA, self.delta(self.last, entries)
+        self.last = entries
+        self.since_keyframe += 1
+        await asyncio.to_thread(self._write, kind, timestamp, payload)
+
+    @staticmethod
+    def delta(previous, entries):
+        """Возвращает разницу между двумя снимками."""
+        payload = {"set": [entry for gift_id, entry in entries.items() if previous.get(gift_id) != entry]}
+        removed = [gift_id for gift_id in previous if gift_id not in entries]
+        if removed:
+            payload["del"] = removed
+        # Порядок по умолчанию: оставшиеся в прежнем порядке, затем новые
+        expected = [gift_id for gift_id in previous if gift_id in entries]
+        expected += [gift_id for gift_id in entries if gift_id not in previous]
+        if expected != list(entries):
+            payload["order"] = list(entries)
+        return payload
 
-            # Находим новые апгрейды
-            new_upgrades_for_gift = [upgrade for upgrade in current_upgrades if upgrade not in previous_upgrades]
-            if new_upgrades_for_gift:
-                new_upgrades.append((gift_id, new_upgrades_for_gift))
-                # Обновляем состояние
-                gifts_state[gift_id]["upgrades"] = current_upgrades
+    def _write(self, kind, timestamp, payload):
+        """Записывает одну запись журнала."""
+        if self.file is None:
+            self.open()
+        data = zlib.compress(json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode())
+        self.file.write(self.HEADER.pack(kind, timestamp, len(data)) + data)
+        self.file.flush()
 
-    # Сохраняем обновлённое состояние
-    save_gifts_state(gifts_state)
+    @classmethod
+    def records(cls, path):
+        """Перебирает целые записи журнала: (смещение конца записи, время, (тип, данные)).
 
-    return new_upgrades
+        Недописанная последняя запись (после аварийной остановки) пропускается. Для записи
+        с повреждёнными данными вместо (тип, данные) возвращается None, а чтение продолжается
+        со следующей. Повреждённый заголовок записи — ValueError: дальше файл не разобрать.
+        """
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size <= len(cls.MAGIC):
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if data[:len(cls.MAGIC)] != cls.MAGIC:
+                    raise ValueError(f"{path} не является журналом снимков")
+                offset = len(cls.MAGIC)
+                while offset + cls.HEADER.size <= len(data):
+                    kind, timestamp, length = cls.HEADER.unpack_from(data, offset)
+                    if kind not in (cls.KEYFRAME, cls.DELTA):
+                        raise ValueError(f"{path}: повреждён заголовок записи на смещении {offset}")
+                    start = offset + cls.HEADER.size
+                    if start + length > len(data):
+                        break
+                    try:
+                        record = kind, json.loads(zlib.decompress(data[start:start + length]))
+                    except (zlib.error, ValueError):
+                        logger.warning("%s: пропущена повреждённая запись на смещении %s", path, offset)
+                        record = None
+                    offset = start + length
+                    yield offset, timestamp, record
+
+    @classmethod
+    def replay(cls, path):
+        """Восстанавливает снимки из журнала: (время, список записей подарков)."""
+        entries = None
+        for _, timestamp, record in cls.records(path):
+            if record is None:
+                entries = None  # Без пропущенной записи дельты до следующего снимка неверны
+                continue
+            kind, payload = record
+            if kind == cls.KEYFRAME:
+                entries = {str(entry["id"]): entry for entry in payload["gifts"]}
+            elif entries is None:
+                continue  # Дельта без снимка перед ней
+            else:
+                for gift_id in payload.get("del", ()):
+                    entries.pop(gift_id, None)
+                for entry in payload["set"]:
+                    entries[str(entry["id"])] = entry
+                if "order" in payload:
+                    entries = {gift_id: entries[gift_id] for gift_id in payload["order"]}
+            yield timestamp, list(entries.values())
+
+snapshot_log = SnapshotLog(SNAPSHOT_LOG_FILE)
+
+# Получаем список подарков, пропуская неизменившиеся ответы
+class GiftsFetcher:
+    """Запрашивает GetAvailableGifts напрямую через HTTP-сессию бота и сравнивает ответы с прошлым.
+
+    Если тело ответа совпадает с прошлым байт в байт, разбор и обработка пропускаются.
+    Иначе заново собираются только подарки, чьи записи в ответе изменились.
+    """
+
+    def __init__(self):
+        self.body_hash = None  # Отпечаток прошлого тела ответа
+        self.entries = {}  # gift_id → запись подарка из прошлого ответа
+        self.gifts = {}  # gift_id → Gift, собранный из этой записи
+
+    async def fetch(self, trace):
+        """Возвращает список подарков или None, если ответ не изменился с прошлого запроса."""
+        method = GetAvailableGifts()
+        with trace.span("fetch"):
+            session = await bot.session.create_session()
+            url = bot.session.api.api_url(token=bot.token, method=method.__api_method__)
+            started = time.perf_counter()
+            try:
+                async with session.post(url, timeout=bot.session.timeout) as resp:
+                    status = resp.status
+                    body = await resp.read()
+            except asyncio.TimeoutError:
+                raise TelegramNetworkError(method=method, message="Request timeout error")
+            except aiohttp.ClientError as e:
+                raise TelegramNetworkError(method=method, message=f"{type(e).__name__}: {e}")
+            finally:
+                telegram_request_seconds.observe(time.perf_counter() - started, method="GetAvailableGifts")
+
+        body_hash = hashlib.blake2b(body, digest_size=16).digest()
+        if status == 200 and body_hash == self.body_hash:
+            return None
+
+        with trace.span("parse"):
+            data = json.loads(body)
+            if status != 200 or not data.get("ok"):
+                # Ошибки разбирает aiogram, чтобы получить те же исключения, что и при bot(...)
+                if status == 429:
+                    telegram_flood_waits_total.inc(method="GetAvailableGifts")
+                bot.session.check_response(bot=bot, method=method, status_code=status, content=body.decode())
+            gifts = self.update(data["result"]["gifts"])
+
+        if not snapshot_log.disabled:
+            with trace.span("record"):
+                try:
+                    await snapshot_log.append(trace.wall_started, self.entries)
+                except Exception as e:
+                    # Журнал не должен мешать обнаружению подарков: после первой ошибки запись выключается
+                    logger.error("Ошибка при записи журнала снимков, запись отключена: %s", e)
+                    snapshot_log.disabled = True
+                    snapshot_log.close()
+        self.body_hash = body_hash
+        return gifts
+
+    def update(self, raw_gifts):
+        """Собирает подарки из записей ответа, заново разбирая только изменившиеся записи."""
+        entries = {}
+        gifts = {}
+        for entry in raw_gifts:
+            gift_id = str(entry["id"])
+            gift = self.gifts.get(gift_id)
+            previous = self.entries.get(gift_id)
+            # При воспроизведении журнала неизменившиеся записи — те же объекты, их не нужно сравнивать
+            if gift is None or (previous is not entry and previous != entry):
+                gift = Gift.model_validate(entry, context={"bot": bot})
+            entries[gift_id] = entry
+            gifts[gift_id] = gift
+        self.entries = entries
+        self.gifts = gifts
+        return list(gifts.values())
+
+fetcher = GiftsFetcher()
+
+# Уведомляем о новом подарке
+async def notify_new_gift(gift):
+    """Запоминает новый подарок и ставит уведомление о нём в очередь."""
+    gift_id = str(gift.id)
+    known_gifts[gift_id] = {
+        "emoji": gift.sticker.emoji,
+        "name": gift.sticker.name if hasattr(gift.sticker, 'name') else "",
+        "star_count": gift.star_count,
+        "total_count": gift.total_count,
+        "remaining_count": gift.remaining_count
+    }
+    save_known_gift(gift_id)
+
+    # Формируем текст для reply
+    gift_info = (
+        f" <b>☝️🔺NEW GIFT AVAILABLE🔺☝️</b>\n"
+        f" \n"
+        f"<b>ID:</b> <code>{gift_id}</code>\n"
+        f"<b>Price:</b> <code>{gift.star_count}</code>★\n"
+        f"<b>Supply:</b> <code>{gift.total_count if gift.total_count else '∞'}</code>"
+    )
+
+    # Событие сразу уходит в локальный поток, а стикер и текст reply к нему встанут в outbox после загрузки стикера
+    publish("new", GiftRecord.from_gift(gift), gift_info, f"new:{gift_id}", details={"emoji": gift.sticker.emoji})
+
+# Уведомляем о достижении уровня остатка
+async def notify_threshold(record, levels, estimate):
+    """Уведомляет о том, что остаток подарка опустился до уровней levels% тиража.
+
+    Одно уведомление приходится на все уровни, пройденные за опрос, и называет самый низкий из них;
+    подписчики с фильтром по уровням получают его, если пройден любой из их уровней.
+    """
+    notified_level = notified_gifts["threshold"].get(record.id)
+    if notified_level is not None:
+        levels = tuple(level for level in levels if level < notified_level)
+    if not levels:
+        return
+    level = levels[-1]
+    rate, eta = estimate
+    notification_text = (
+        f"⚠️ <b>Gift low supply ALERT!</b> (≤{level:g}%)\n"
+        f"<b>ID:</b> <code>{record.id}</code>\n"
+        f"<b>Осталось:</b> <code>{record.remaining_count}/{record.total_count}</code>\n"
+        f"<b>Скорость:</b> <code>{rate:.1f}</code>/мин\n"
+        f"<b>Раскупят через:</b> <code>{format_eta(eta)}</code>"
+    )
+    publish("threshold", record, notification_text, f"threshold:{record.id}:{level:g}", levels,
+            {"rate_per_minute": rate, "eta": eta})
+
+    # Сохраняем информацию об уведомлении
+    save_notified_gift("threshold", record.id, level)
+    logger.info("Уведомление о пороге %g%% для подарка %s сохранено.", level, record.id)
+
+# Уведомляем о быстрых продажах
+async def notify_rate(record, estimate, now):
+    """Уведомляет о том, что подарок продаётся быстрее RATE_ALERT_PER_MINUTE в минуту."""
+    rate, eta = estimate
+    if not RATE_ALERT_PER_MINUTE or rate <= RATE_ALERT_PER_MINUTE:
+        return
+    if now - rate_alerts.get(record.id, float("-inf")) < RATE_ALERT_COOLDOWN:
+        return
+    rate_alerts[record.id] = now
+    notification_text = (
+        f"🔥 <b>Gift selling FAST!</b>\n"
+        f"<b>ID:</b> <code>{record.id}</code>\n"
+        f"<b>Скорость:</b> <code>{rate:.1f}</code>/мин\n"
+        f"<b>Осталось:</b> <code>{record.remaining_count}/{record.total_count}</code>\n"
+        f"<b>Раскупят через:</b> <code>{format_eta(eta)}</code>"
+    )
+    publish("rate", record, notification_text, f"rate:{record.id}:{int(now)}",
+            details={"rate_per_minute": rate, "eta": eta})
+
+# Уведомляем о том, что подарок раскуплен
+async def notify_sold_out(record):
+    """Уведомляет о том, что подарок полностью раскуплен."""
+    if record.id in notified_gifts["sold_out"]:
+        return
+    notification_text = (
+        f"🛑 <b>Gift SOLD!</b>\n"
+        f"<b>ID:</b> <code>{record.id}</code>"
+    )
+    publish("sold_out", record, notification_text, f"sold_out:{record.id}")
+
+    # Сохраняем информацию об уведомлении
+    save_notified_gift("sold_out", record.id)
+    logger.info("Уведомление о раскупленности для подарка %s сохранено.", record.id)
 
 # Отправляем уведомление о новых апгрейдах
 async def send_upgrade_notification(gift_id, upgrades):
@@ -350,109 +2208,380 @@ async def send_upgrade_notification(gift_id, upgrades):
     for upgrade in upgrades:
         notification_text += f"- {upgrade}\n"
 
-    # Отправляем уведомление в канал
-    sticker_file_id = stickers_data.get(gift_id)
-    if sticker_file_id:
-        sticker_message_id = await send_sticker(CHANNEL_ID, sticker_file_id)
-        if sticker_message_id:
-            await send_text_as_reply(CHANNEL_ID, notification_text, sticker_message_id)
+    # Рассылаем уведомление подписчикам
+    upgrades_hash = hashlib.blake2b("\n".join(upgrades).encode(), digest_size=8).hexdigest()
+    record = GiftRecord.from_state(gift_id, gifts_state.get(gift_id, {}))
+    publish("upgrade", record, notification_text, f"upgrade:{gift_id}:{upgrades_hash}",
+            details={"upgrades": list(upgrades)})
+
+# Уведомляем о снятом с продажи подарке
+async def notify_removed(record):
+    """Уведомляет о том, что подарок пропал из списка доступных."""
+    notification_text = (
+        f"🚫 <b>Gift REMOVED!</b>\n"
+        f"<b>ID:</b> <code>{record.id}</code>\n"
+        f"<b>Осталось:</b> <code>{record.remaining_count if record.is_limited() else '∞'}</code>"
+    )
+    # О раскупленном подарке уже было уведомление SOLD, повторять его снятием с продажи незачем
+    sold_out = record.is_limited() and record.remaining_count == 0
+    publish("removed", record, notification_text, f"removed:{record.id}:{int(detected_at.get() or time.time())}",
+            notify=not sold_out)
+
+# Применяем изменения снимка
+async def process_changeset(changeset, now):
+    """Сохраняет изменения снимка и рассылает уведомления по ним."""
+    for record in changeset.changed:
+        gifts_state[record.id] = record.to_state()
+        save_gift_state(record.id)
+        if record.is_limited():
+            supply_history.record(record.id, now, record.remaining_count)
+    for record in changeset.removed + changeset.forgotten:
+        gifts_state.pop(record.id, None)
+        state_store.stage("gifts_state", record.id, None)
+        supply_history.drop(record.id)
+    # Прогноз нужен только для уведомлений о порогах и скорости продаж
+    need_estimates = changeset.threshold_crossed or (RATE_ALERT_PER_MINUTE and changeset.remaining_deltas)
+    estimates = supply_history.estimate(now) if need_estimates else {}
+
+    # Сначала все события цикла уходят в локальный поток, и только потом идут обращения к Telegram
+    new_gifts = [gift for gift in changeset.added if str(gift.id) not in known_gifts]
+    if new_gifts:
+        logger.info("NEW GIFTS ALERT. Найдено новых подарков: %s", len(new_gifts))
+        for gift in new_gifts:
+            await notify_new_gift(gift)
     else:
-        logger.error(f"Стикер для подарка {gift_id} не найден в stickers.json.")
+        logger.debug("Новых подарков нет.")
+
+    for record in changeset.removed:
+        logger.info("Подарок %s снят с продажи.", record.id)
+        await notify_removed(record)
+    for record, levels in changeset.threshold_crossed:
+        await notify_threshold(record, levels, estimates.get(record.id, (0.0, None)))
+    if RATE_ALERT_PER_MINUTE:
+        for record in changeset.changed:
+            if record.id in changeset.remaining_deltas:
+                await notify_rate(record, estimates[record.id], now)
+    for record in changeset.sold_out:
+        await notify_sold_out(record)
+    for gift_id, upgrades in changeset.upgrades:
+        await send_upgrade_notification(gift_id, upgrades)
+
+    try:
+        if new_gifts:
+            # Добавляем стикеры всех новых подарков в стикерпак одной пачкой
+            await ensure_gift_stickers(new_gifts)
+    finally:
+        # Уведомления ставятся в outbox в порядке событий, даже если загрузить стикеры не удалось
+        queue_notifications()
 
 # Проверяем новые подарки
-async def check_new_gifts():
-    global known_gifts
+async def check_new_gifts(current_gifts, trace, now=None):
+    """Сравнивает полученный список подарков с прошлым снимком и обрабатывает изменения."""
+    now = trace.wall_started if now is None else now
+    detected_at.set(now)
     try:
-        # Получаем все доступные подарки
-        current_gifts = await bot(GetAvailableGifts())
+        with trace.span("diff"):
+            changeset = differ.diff(current_gifts)
+        scheduler.observe(changeset)
+        with trace.span("process"):
+            await process_changeset(changeset, now)
+    finally:
+        # Записываем все изменения цикла одной транзакцией
+        try:
+            with trace.span("persist"):
+                await state_store.commit()
+            outbox.wake()
+        except sqlite3.Error as e:
+            logger.error("Ошибка при сохранении состояния: %s", e)
+        trace.finish()
 
-        # Проверяем новые подарки
-        new_gifts = [gift for gift in current_gifts.gifts if str(gift.id) not in known_gifts]
+# Планировщик опроса
+class PollScheduler:
+    """Опрашивает GetAvailableGifts по сетке времени, не зависящей от длительности обработки.
 
-        if new_gifts:
-            logger.info(f"NEW GIFTS ALERT. Найдено новых подарков: {len(new_gifts)}")
-            for gift in new_gifts:
-                gift_id = str(gift.id)
-                known_gifts[gift_id] = {
-                    "emoji": gift.sticker.emoji,
-                    "name": gift.sticker.name if hasattr(gift.sticker, 'name') else "",
-                    "star_count": gift.star_count,
-                    "total_count": gift.total_count,
-                    "remaining_count": gift.remaining_count
-                }
-
-                # Если стикерпак не существует, создаём его
-                if not await sticker_set_exists(STICKER_SET_NAME):
-                    await create_sticker_set_from_gifts([gift])
-                else:
-                    await add_stickers_to_set([gift])
-
-                # Отправляем стикер и получаем его message_id
-                if gift_id in stickers_data:
-                    sticker_file_id = stickers_data[gift_id]  # Получаем file_id стикера из stickers.json
-                    sticker_message_id = await send_sticker(CHANNEL_ID, sticker_file_id)
-
-                    if sticker_message_id:
-                        # Формируем текст для reply
-                        gift_info = (
-                            f" <b>☝️🔺NEW GIFT AVAILABLE🔺☝️</b>\n"
-                            f" \n"
-                            f"<b>ID:</b> <code>{gift_id}</code>\n"
-                            f"<b>Price:</b> <code>{gift.star_count}</code>★\n"
-                            f"<b>Supply:</b> <code>{gift.total_count if gift.total_count else '∞'}</code>"
-                        )
-
-                        # Отправляем текст как reply к стикеру
-                        await send_text_as_reply(CHANNEL_ID, gift_info, sticker_message_id)
-                    else:
-                        logger.error(f"Не удалось отправить стикер для подарка {gift_id}.")
-                else:
-                    logger.error(f"Стикер для подарка {gift_id} не найден в stickers.json.")
+    Опрос и обработка идут в разных задачах: опрос кладёт свежий список подарков в слот,
+    обработка забирает последний из них. Пока подарки раскупаются или появляются новые,
+    интервал сжимается до минимального, в тишине — плавно растёт до максимального.
+    """
 
-            save_known_gifts()
-        else:
-            logger.info("Новых подарков нет.")
-
-        # Проверяем все подарки на порог 11%
-        for gift in current_gifts.gifts:
-            await check_gift_threshold(gift)
-
-        # Проверяем новые апгрейды
-        new_upgrades = await check_for_upgrades(current_gifts)
-        if new_upgrades:
-            for gift_id, upgrades in new_upgrades:
-                await send_upgrade_notification(gift_id, upgrades)
-
-    except TelegramAPIError as e:
-        if "Too Many Requests" in str(e):
-            retry_after = int(e.message.split("retry after ")[1])
-            logger.warning(f"Лимит запросов превышен. Ждём {retry_after} секунд...")
-            await asyncio.sleep(retry_after)
-            await check_new_gifts()  # Повторяем запрос после паузы
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 requests_per_minute=POLL_REQUESTS_PER_MINUTE, backoff=POLL_BACKOFF):
+        # Минимальный интервал не даёт выйти за бюджет запросов в минуту
+        self.min_interval = max(min_interval, 60 / requests_per_minute)
+        self.max_interval = max(max_interval, self.min_interval)
+        self.backoff = backoff
+        self.interval = self.min_interval
+        self.latest = None  # Последний полученный и ещё не обработанный список подарков с трассировкой цикла
+        self.ready = asyncio.Event()
+
+    def observe(self, changeset):
+        """Подстраивает интервал под активность: новые подарки и продажи ускоряют опрос."""
+        active = changeset.added or any(delta < 0 for delta in changeset.remaining_deltas.values())
+        if active:
+            self.interval = self.min_interval
         else:
-            logger.error(f"Ошибка при проверке новых подарков: {e}")
+            self.slow_down()
+
+    def slow_down(self):
+        """Увеличивает интервал опроса, если ничего не происходит."""
+        self.interval = min(self.max_interval, self.interval * self.backoff)
+
+    async def run_polling(self):
+        """Опрашивает Telegram с фиксированным темпом."""
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            delay = 0
+            trace = CycleTrace()
+            try:
+                current_gifts = await fetcher.fetch(trace)
+                if current_gifts is None:
+                    logger.debug("Список подарков не изменился.")
+                    polls_total.inc(result="unchanged")
+                    trace.finish()
+                    self.slow_down()
+                else:
+                    # Необработанный старый список заменяется свежим: разница с прошлым снимком не теряется
+                    polls_total.inc(result="changed")
+                    self.latest = (current_gifts, trace)
+                    self.ready.set()
+            except TelegramRetryAfter as e:
+                # Flood wait на опрос сдвигает только следующий опрос, отправка уведомлений продолжается
+                polls_total.inc(result="error")
+                delay = e.retry_after
+                logger.warning("Лимит запросов превышен. Ждём %s секунд...", delay)
+            except Exception as e:
+                polls_total.inc(result="error")
+                logger.error("Ошибка при проверке новых подарков: %s", e)
+
+            next_tick += max(self.interval, delay)
+            now = loop.time()
+            if next_tick < now:
+                # Опрос занял больше интервала: пропускаем опоздавшие такты, а не догоняем их пачкой
+                next_tick = now
+            await asyncio.sleep(next_tick - now)
+
+    async def run_processing(self):
+        """Обрабатывает последний полученный список подарков."""
+        while True:
+            await self.ready.wait()
+            self.ready.clear()
+            (current_gifts, trace), self.latest = self.latest, None
+            try:
+                await check_new_gifts(current_gifts, trace)
+            except Exception as e:
+                logger.error("Ошибка при обработке подарков: %s", e)
+
+scheduler = PollScheduler()
+
+# Ошибка: другой процесс забрал лидерство
+class LeadershipLost(Exception):
+    """Аренда лидерства не продлена вовремя."""
+
+# Лидерство среди процессов
+class LeaderLease:
+    """Аренда лидерства в общей базе: опрашивает подарки только процесс, который её держит.
+
+    Лидер продлевает аренду каждые ttl/3 секунд. Если он упал или завис, аренда истекает
+    через ttl секунд и её забирает другой процесс. Лидер, не сумевший продлить аренду,
+    завершается, чтобы два процесса не опрашивали и не писали состояние одновременно.
+    """
+
+    def __init__(self, store, name="poller", ttl=LEADER_LEASE_TTL):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.owner = f"{CLUSTER_NODE}:{os.getpid()}"
+
+    async def try_acquire(self):
+        """Пытается взять или продлить аренду. Возвращает True, если она у этого процесса."""
+        try:
+            return await self.store.run(self.store.acquire_lease, self.name, self.owner, self.ttl)
+        except sqlite3.Error as e:
+            logger.error("Ошибка при продлении лидерства: %s", e)
+            return False
+
+    async def acquire(self):
+        """Ждёт, пока аренда не достанется этому процессу."""
+        while not await self.try_acquire():
+            await asyncio.sleep(self.ttl / 3)
+
+    async def keep(self):
+        """Продлевает аренду; если не удалось до её истечения, выбрасывает LeadershipLost."""
+        renewed = time.time()
+        while True:
+            await asyncio.sleep(self.ttl / 3)
+            if await self.try_acquire():
+                renewed = time.time()
+            elif time.time() - renewed >= self.ttl:
+                raise LeadershipLost(f"Лидерство процесса {self.owner} потеряно")
+
+    async def release(self):
+        """Освобождает аренду, чтобы другой процесс сразу стал лидером."""
+        try:
+            await self.store.run(self.store.release_lease, self.name, self.owner)
+        except sqlite3.Error as e:
+            logger.error("Ошибка при освобождении лидерства: %s", e)
+
+leader_lease = LeaderLease(state_store)
+
+# Опрашиваем подарки, пока этот процесс лидер
+async def run_leader():
+    """Загружает состояние и опрашивает подарки. Из нескольких процессов это делает только лидер."""
+    if CLUSTER_SIZE > 1:
+        await leader_lease.acquire()
+        logger.info("Процесс %s стал лидером и опрашивает подарки.", CLUSTER_NODE)
+
+    # Загружаем данные о подарках, стикерах и уведомлениях
+    load_state()
+    differ.seed(gifts_state)
+    subscribers.load()
+    logger.info("Подписчиков: %s", len(subscribers))
+    # Индекс стикерпака нужен, чтобы записать file_unique_id стикеров для процессов с другими токенами
+    await sticker_set_exists()
+
+    # Опрос и обработка работают независимо: медленная отправка не задерживает следующий запрос
+    tasks = [asyncio.create_task(scheduler.run_polling()), asyncio.create_task(scheduler.run_processing())]
+    if CLUSTER_SIZE > 1:
+        tasks.append(asyncio.create_task(leader_lease.keep()))
+    lost = False
+    try:
+        await asyncio.gather(*tasks)
+    except LeadershipLost:
+        lost = True
+        raise
+    finally:
+        # Останавливаем опрос и обработку до любой очистки в main(): gather сам их не отменяет
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if lost:
+            # Новый лидер уже мог начать опрос, поэтому несохранённые изменения этого цикла не записываем
+            state_store.discard()
 
 # Основная функция
 async def main():
-    global known_gifts, stickers_data, notified_gifts
     logger.info("Запуск бота...")
 
-    # Инициализируем файл для уведомлений
-    initialize_notified_gifts()
+    # Открываем базу и при первом запуске переносим в неё старые JSON-файлы
+    state_store.open()
+    state_store.migrate_from_json()
 
-    # Загружаем данные о подарках и стикерах
-    known_gifts = load_known_gifts()
-    stickers_data = load_stickers_data()
-    notified_gifts = load_notified_gifts()
+    # Запускаем воркеры отправки уведомлений, цикл outbox и локальный HTTP-сервер
+    dispatcher.start()
+    outbox_task = asyncio.create_task(outbox.run())
+    local_api = await start_local_api()
 
     try:
-        while True:
-            await check_new_gifts()
-            await asyncio.sleep(10)
+        await run_leader()
     except KeyboardInterrupt:
         logger.info("Бот остановлен вручную.")
     finally:
+        if local_api is not None:
+            await local_api.cleanup()
+        outbox_task.cancel()
+        await dispatcher.stop()  # Дожидаемся отправки оставшихся уведомлений (остальные останутся в outbox)
+        await state_store.commit()
+        if CLUSTER_SIZE > 1:
+            await leader_lease.release()
+        state_store.close()
+        snapshot_log.close()
         await bot.session.close()  # Закрываем сессию бота
+        if delivery_bot is not bot:
+            await delivery_bot.session.close()
+
+# Запускаем несколько процессов
+async def run_cluster():
+    """Запускает по процессу на каждый токен из BOT_TOKENS и перезапускает упавшие.
+
+    Все процессы отправляют уведомления своих чатов каждый своим токеном, а опрашивает
+    подарки один из них — тот, кто держит аренду лидерства. Стикерпак и опрос всегда
+    идут от BOT_TOKEN. Каждый бот из BOT_TOKENS должен иметь право писать в чаты подписчиков.
+    """
+    tokens = BOT_TOKENS or [BOT_TOKEN]
+    processes = {}
+
+    async def supervise(node, token):
+        env = dict(os.environ, DELIVERY_BOT_TOKEN=token, CLUSTER_NODE=str(node), CLUSTER_SIZE=str(len(tokens)))
+        if LOCAL_API_PORT:
+            env["LOCAL_API_PORT"] = str(LOCAL_API_PORT + node)  # Свой порт метрик у каждого процесса
+        while True:
+            processes[node] = await asyncio.create_subprocess_exec(sys.executable, os.path.abspath(__file__), env=env)
+            code = await processes[node].wait()
+            logger.error("Процесс %s завершился с кодом %s. Перезапуск через %s секунд...", node, code, CLUSTER_RESTART_DELAY)
+            await asyncio.sleep(CLUSTER_RESTART_DELAY)
+
+    logger.info("Запуск %s процессов...", len(tokens))
+    try:
+        await asyncio.gather(*(supervise(node, token) for node, token in enumerate(tokens)))
+    finally:
+        for process in processes.values():
+            if process.returncode is None:
+                process.terminate()
+        await asyncio.gather(*(process.wait() for process in processes.values()))
+
+# Воспроизводим журнал снимков
+async def run_replay(argv):
+    """Прогоняет журнал снимков через обнаружение изменений без обращений к Telegram и печатает итог.
+
+    Время каждого снимка берётся из журнала, поэтому скорость продаж, прогнозы и паузы между
+    уведомлениями считаются так же, как при записи. Состояние хранится в отдельной базе
+    (по умолчанию в памяти), а уведомления остаются в её outbox и не отправляются.
+    """
+    global replay_mode
+    parser = argparse.ArgumentParser(prog="gifts.py replay", description="Воспроизведение журнала снимков GetAvailableGifts")
+    parser.add_argument("path", nargs="?", default=SNAPSHOT_LOG_FILE, help="Журнал снимков")
+    parser.add_argument("--speed", type=float, default=0, help="Во сколько раз быстрее записи воспроизводить (0 — без пауз)")
+    parser.add_argument("--interval", type=float, default=0, help="Брать снимки не чаще, чем раз в N секунд (имитация редкого опроса)")
+    parser.add_argument("--db", default=":memory:", help="База для состояния при воспроизведении")
+    parser.add_argument("--events", action="store_true", help="Вывести все уведомления")
+    parser.add_argument("--verbose", action="store_true", help="Не скрывать INFO-сообщения в логе")
+    args = parser.parse_args(argv)
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+    replay_mode = True
+    state_store.path = args.db
+    state_store.open()
+    load_state()
+    differ.seed(gifts_state)
+    subscribers.load()
+
+    snapshots = 0
+    first = previous = None
+    started = time.perf_counter()
+    for timestamp, raw_gifts in SnapshotLog.replay(args.path):
+        if previous is not None:
+            if timestamp - previous < args.interval:
+                continue
+            if args.speed:
+                await asyncio.sleep((timestamp - previous) / args.speed)
+        first = timestamp if first is None else first
+        previous = timestamp
+        await check_new_gifts(fetcher.update(raw_gifts), CycleTrace(), now=timestamp)
+        snapshots += 1
+    elapsed = time.perf_counter() - started
+
+    rows = state_store.conn.execute("SELECT key, chat_id, detected_at FROM outbox ORDER BY id").fetchall()
+    state_store.close()
+    if args.events:
+        for key, chat_id, detected in rows:
+            print(f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(detected))}  {chat_id}  {key.split('@')[0]}")
+    by_type = {}
+    for key, _, _ in rows:
+        event = key.split(":", 1)[0]
+        by_type[event] = by_type.get(event, 0) + 1
+    span = previous - first if snapshots else 0
+    print(f"Снимков: {snapshots} за {span / 3600:.1f} ч записи, воспроизведено за {elapsed:.1f} с")
+    print(f"Уведомлений: {len(rows)} в {len({chat_id for _, chat_id, _ in rows})} чатов")
+    for event, count in sorted(by_type.items()):
+        print(f"  {event}: {count}")
 
 if __name__ == '__main__':
-    asyncio.run(main())
\ No newline at end of file
+    mode = sys.argv[1] if len(sys.argv) > 1 else None
+    if mode == "cluster":
+        asyncio.run(run_cluster())
+    elif mode == "replay":
+        asyncio.run(run_replay(sys.argv[2:]))
+    else:
+        asyncio.run(main())
\ No newline at end of file